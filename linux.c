@@ -5,8 +5,31 @@
 #include <sched.h>
 #include <sys/wait.h>
 #include <unistd.h>
+#include <errno.h>
+#include <string.h>
+#include <net/if.h>
+#include <arpa/inet.h>
+#include <linux/netlink.h>
+#include <linux/rtnetlink.h>
+#include <linux/veth.h>
+#include <stdint.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <sys/stat.h>
+#include <sys/sysmacros.h>
 
 #define STACK_SIZE 32768
+#define NL_BUFSIZE 4096
+
+#ifndef SYS_clone3
+#define SYS_clone3 435
+#endif
+#ifndef CLONE_PIDFD
+#define CLONE_PIDFD 0x00001000
+#endif
+#ifndef CLONE_INTO_CGROUP
+#define CLONE_INTO_CGROUP 0x200000000ULL
+#endif
 
 #define LINUX_MODULE_DOC "linux\n"\
                          "=====\n"\
@@ -68,12 +91,17 @@ static PyObject *
 _mount(PyObject *self, PyObject *args) {
 	const char *source, *target, *filesystemtype, *mountopts;
 	unsigned long mountflags;
+	int ret;
 
 	if (!PyArg_ParseTuple(args, "zszkz", &source, &target, &filesystemtype, &mountflags, &mountopts)) {
 		return NULL;
 	}
 
-	if (mount(source, target, filesystemtype, mountflags, mountopts) == -1) {
+	/* an overlay mount can take a while, let other threads run meanwhile */
+	Py_BEGIN_ALLOW_THREADS
+	ret = mount(source, target, filesystemtype, mountflags, mountopts);
+	Py_END_ALLOW_THREADS
+	if (ret == -1) {
 		PyErr_SetFromErrno(PyExc_RuntimeError);
 		return NULL;
 	} else {
@@ -94,12 +122,16 @@ _mount(PyObject *self, PyObject *args) {
 static PyObject *
 _umount(PyObject *self, PyObject *args) {
 	const char *target;
+	int ret;
 
 	if (!PyArg_ParseTuple(args, "s", &target)) {
 		return NULL;
 	}
 
-	if (umount(target) == -1) {
+	Py_BEGIN_ALLOW_THREADS
+	ret = umount(target);
+	Py_END_ALLOW_THREADS
+	if (ret == -1) {
 		PyErr_SetFromErrno(PyExc_RuntimeError);
 		return NULL;
 	} else {
@@ -171,6 +203,36 @@ _unshare(PyObject *self, PyObject *args) {
 	}
 }
 
+#define IOPRIO_SET_DOC ".. py:function:: ioprio_set(which, who, ioprio)\n"\
+                    "\n"\
+                    "set the I/O scheduling class and priority of a process, thread or group\n"\
+                    "\n"\
+                    ":param int which: ``linux.IOPRIO_WHO_PROCESS``, ``linux.IOPRIO_WHO_PGRP`` or\n"\
+                    "                  ``linux.IOPRIO_WHO_USER``\n"\
+                    ":param int who: the id of the target, ``0`` is the calling thread\n"\
+                    ":param int ioprio: ``class << linux.IOPRIO_CLASS_SHIFT | level``, e.g.\n"\
+                    "                   ``linux.IOPRIO_CLASS_IDLE << linux.IOPRIO_CLASS_SHIFT``\n"\
+                    ":return: None\n"\
+                    ":raises RuntimeError: if ioprio_set fails\n"\
+                    "\n"
+
+static PyObject *
+_ioprio_set(PyObject *self, PyObject *args) {
+	int which, who, ioprio;
+
+	if (!PyArg_ParseTuple(args, "iii", &which, &who, &ioprio))
+		return NULL;
+
+	// glibc has no wrapper
+	if (syscall(SYS_ioprio_set, which, who, ioprio) == -1) {
+		PyErr_SetFromErrno(PyExc_RuntimeError);
+		return NULL;
+	} else {
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+}
+
 #define SETNS_DOC   ".. py:function:: setns(fd, nstype)\n"\
                     "\n"\
                     "reassociate process with a namespace\n"\
@@ -217,7 +279,7 @@ static int clone_callback(void *args) {
 	return 0;
 }
 
-#define CLONE_DOC   ".. py:function:: clone(callback, flags, callback_args)\n"\
+#define CLONE_DOC   ".. py:function:: clone(callback, flags, callback_args, stack_size=32768)\n"\
                     "\n"\
                     "create a child process\n"\
                     "\n"\
@@ -225,6 +287,7 @@ static int clone_callback(void *args) {
                     ":param int flags: combination (using ``|``) of flags specifying what should be shared\n"\
                     "                  between the calling process and the child process. See below.\n"\
                     ":param tuple callback_args: tuple of arguments for the callback function\n"\
+                    ":param int stack_size: size in bytes of the stack the child starts on\n"\
                     ":return: On success, the thread ID of the child process\n"\
                     ":raises RuntimeError: if clone fails\n"\
                     "\n"\
@@ -241,11 +304,10 @@ _clone(PyObject *self, PyObject *args) {
 	PyObject *callback, *callback_args;
 	void *child_stack;
 	int flags;
+	unsigned long stack_size = STACK_SIZE;
 	pid_t child_pid;
 
-	child_stack = malloc(STACK_SIZE);
-
-	if (!PyArg_ParseTuple(args, "OiO", &callback, &flags, &callback_args))
+	if (!PyArg_ParseTuple(args, "OiO|k", &callback, &flags, &callback_args, &stack_size))
 		return NULL;
 
 	if (!PyCallable_Check(callback)) {
@@ -257,7 +319,15 @@ _clone(PyObject *self, PyObject *args) {
     call_args.callback = callback;
     call_args.callback_args = callback_args;
 
-	if ((child_pid = clone(&clone_callback, child_stack + STACK_SIZE, flags | SIGCHLD, &call_args)) == -1) {
+	if ((child_stack = malloc(stack_size)) == NULL)
+		return PyErr_NoMemory();
+
+	child_pid = clone(&clone_callback, child_stack + stack_size, flags | SIGCHLD, &call_args);
+
+	// without CLONE_VM the child runs on its own copy of the stack
+	free(child_stack);
+
+	if (child_pid == -1) {
 			PyErr_SetFromErrno(PyExc_RuntimeError);
 			return Py_BuildValue("i", -1);
 	} else {
@@ -265,6 +335,82 @@ _clone(PyObject *self, PyObject *args) {
 	}
 }
 
+/* struct clone_args of clone3(2), not exported by every libc */
+struct clone3_args {
+	uint64_t flags;
+	uint64_t pidfd;
+	uint64_t child_tid;
+	uint64_t parent_tid;
+	uint64_t exit_signal;
+	uint64_t stack;
+	uint64_t stack_size;
+	uint64_t tls;
+	uint64_t set_tid;
+	uint64_t set_tid_size;
+	uint64_t cgroup;
+};
+
+#define CLONE3_DOC  ".. py:function:: clone3(callback, flags, callback_args, cgroup_fd=-1)\n"\
+                    "\n"\
+                    "create a child process with clone3, optionally placing it into a cgroup\n"\
+                    "\n"\
+                    ":param Callable callback: python function to be executed by the child\n"\
+                    ":param int flags: combination (using ``|``) of clone flags, see :py:func:`clone`\n"\
+                    ":param tuple callback_args: tuple of arguments for the callback function\n"\
+                    ":param int cgroup_fd: file descriptor of a cgroup v2 directory the child is\n"\
+                    "                      created in (``CLONE_INTO_CGROUP``), ``-1`` for the caller's cgroup\n"\
+                    ":return: tuple of the child pid and a pidfd referring to the child\n"\
+                    ":raises RuntimeError: if clone3 fails\n"\
+                    "\n"\
+                    "Unlike :py:func:`clone` no stack is allocated: like fork, the child continues on a\n"\
+                    "copy-on-write copy of the caller's stack and exits once the callback returns.\n"
+
+static PyObject *
+_clone3(PyObject *self, PyObject *args) {
+	PyObject *callback, *callback_args;
+	unsigned long long flags;
+	int cgroup_fd = -1, pidfd = -1, saved_errno;
+	struct clone3_args cl_args;
+	struct py_clone_args call_args;
+	long child_pid;
+
+	if (!PyArg_ParseTuple(args, "OKO|i", &callback, &flags, &callback_args, &cgroup_fd))
+		return NULL;
+
+	if (!PyCallable_Check(callback)) {
+		PyErr_SetString(PyExc_TypeError, "parameter must be callable");
+		return NULL;
+	}
+
+	call_args.callback = callback;
+	call_args.callback_args = callback_args;
+
+	memset(&cl_args, 0, sizeof(cl_args));
+	cl_args.flags = flags | CLONE_PIDFD;
+	cl_args.pidfd = (uint64_t)(uintptr_t)&pidfd;
+	cl_args.exit_signal = SIGCHLD;
+	if (cgroup_fd >= 0) {
+		cl_args.flags |= CLONE_INTO_CGROUP;
+		cl_args.cgroup = cgroup_fd;
+	}
+
+	PyOS_BeforeFork();
+	child_pid = syscall(SYS_clone3, &cl_args, sizeof(cl_args));
+	if (child_pid == 0) {
+		PyOS_AfterFork_Child();
+		_exit(clone_callback(&call_args) == 0 ? 0 : 1);
+	}
+	saved_errno = errno;
+	PyOS_AfterFork_Parent();
+
+	if (child_pid == -1) {
+		errno = saved_errno;
+		PyErr_SetFromErrno(PyExc_RuntimeError);
+		return NULL;
+	}
+	return Py_BuildValue("(li)", child_pid, pidfd);
+}
+
 #define SETHOSTNAME_DOC ".. py:function:: sethostname(hostname)\n"\
                         "\n"\
                         "set the system hostname\n"\
@@ -290,15 +436,773 @@ _sethostname(PyObject *self, PyObject *args) {
 	return Py_None;
 }
 
+/*
+ * rtnetlink helpers, so that network setup does not need to fork ip/brctl.
+ * A request is built in a single buffer and sent on a fresh NETLINK_ROUTE
+ * socket of the calling process' network namespace, then the ack is read back.
+ */
+
+struct nl_req {
+	char buf[NL_BUFSIZE] __attribute__((aligned(NLMSG_ALIGNTO)));
+};
+
+#define NL_HDR(req) ((struct nlmsghdr *)(req)->buf)
+
+static void nl_init(struct nl_req *req, int type, int flags) {
+	memset(req, 0, sizeof(*req));
+	NL_HDR(req)->nlmsg_len = NLMSG_LENGTH(0);
+	NL_HDR(req)->nlmsg_type = type;
+	NL_HDR(req)->nlmsg_flags = NLM_F_REQUEST | NLM_F_ACK | flags;
+}
+
+static void *nl_tail(struct nl_req *req) {
+	return (char *)NL_HDR(req) + NLMSG_ALIGN(NL_HDR(req)->nlmsg_len);
+}
+
+static void *nl_put(struct nl_req *req, const void *data, size_t len) {
+	void *p = nl_tail(req);
+	memcpy(p, data, len);
+	NL_HDR(req)->nlmsg_len = NLMSG_ALIGN(NL_HDR(req)->nlmsg_len) + len;
+	return p;
+}
+
+static struct rtattr *nl_attr(struct nl_req *req, int type, const void *data, size_t len) {
+	struct rtattr *rta = nl_tail(req);
+	rta->rta_type = type;
+	rta->rta_len = RTA_LENGTH(len);
+	if (len)
+		memcpy(RTA_DATA(rta), data, len);
+	NL_HDR(req)->nlmsg_len = NLMSG_ALIGN(NL_HDR(req)->nlmsg_len) + RTA_ALIGN(rta->rta_len);
+	return rta;
+}
+
+static void nl_nest_end(struct nl_req *req, struct rtattr *nest) {
+	nest->rta_len = (char *)nl_tail(req) - (char *)nest;
+}
+
+static int nl_talk(struct nl_req *req) {
+	struct sockaddr_nl sa = { .nl_family = AF_NETLINK };
+	char buf[NL_BUFSIZE];
+	struct nlmsghdr *nh;
+	ssize_t len;
+	int fd, err = 0;
+
+	if ((fd = socket(AF_NETLINK, SOCK_RAW | SOCK_CLOEXEC, NETLINK_ROUTE)) == -1)
+		return -1;
+
+	if (sendto(fd, NL_HDR(req), NL_HDR(req)->nlmsg_len, 0, (struct sockaddr *)&sa, sizeof(sa)) == -1) {
+		close(fd);
+		return -1;
+	}
+
+	if ((len = recv(fd, buf, sizeof(buf), 0)) == -1) {
+		close(fd);
+		return -1;
+	}
+	close(fd);
+
+	for (nh = (struct nlmsghdr *)buf; NLMSG_OK(nh, len); nh = NLMSG_NEXT(nh, len)) {
+		if (nh->nlmsg_type == NLMSG_ERROR) {
+			err = ((struct nlmsgerr *)NLMSG_DATA(nh))->error;
+			break;
+		}
+	}
+
+	if (err) {
+		errno = -err;
+		return -1;
+	}
+	return 0;
+}
+
+static int nl_ifindex(const char *name) {
+	int index;
+
+	if ((index = if_nametoindex(name)) == 0)
+		PyErr_SetFromErrnoWithFilename(PyExc_RuntimeError, name);
+	return index;
+}
+
+static PyObject *nl_result(struct nl_req *req) {
+	int ret;
+
+	/* the kernel may take the rtnl lock for a while, e.g. with many links */
+	Py_BEGIN_ALLOW_THREADS
+	ret = nl_talk(req);
+	Py_END_ALLOW_THREADS
+	if (ret == -1) {
+		PyErr_SetFromErrno(PyExc_RuntimeError);
+		return NULL;
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+/* the requests below are shared by the python wrappers and spawn() */
+
+static void nl_link_up_req(struct nl_req *req, unsigned int index) {
+	struct ifinfomsg ifi = { .ifi_family = AF_UNSPEC, .ifi_flags = IFF_UP, .ifi_change = IFF_UP };
+
+	ifi.ifi_index = index;
+	nl_init(req, RTM_NEWLINK, 0);
+	nl_put(req, &ifi, sizeof(ifi));
+}
+
+static void nl_addr_add_req(struct nl_req *req, unsigned int index, const struct in_addr *addr,
+                            int prefixlen) {
+	struct ifaddrmsg ifa = { .ifa_family = AF_INET, .ifa_scope = RT_SCOPE_UNIVERSE };
+
+	ifa.ifa_index = index;
+	ifa.ifa_prefixlen = prefixlen;
+	nl_init(req, RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL);
+	nl_put(req, &ifa, sizeof(ifa));
+	nl_attr(req, IFA_LOCAL, addr, sizeof(*addr));
+	nl_attr(req, IFA_ADDRESS, addr, sizeof(*addr));
+}
+
+/* dst NULL for the default route, oif 0 to let the kernel pick the link */
+static void nl_route_add_req(struct nl_req *req, const struct in_addr *dst, int prefixlen,
+                             const struct in_addr *gw, unsigned int oif) {
+	struct rtmsg rtm = {
+		.rtm_family = AF_INET,
+		.rtm_table = RT_TABLE_MAIN,
+		.rtm_protocol = RTPROT_BOOT,
+		.rtm_scope = RT_SCOPE_UNIVERSE,
+		.rtm_type = RTN_UNICAST,
+	};
+
+	nl_init(req, RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL);
+	rtm.rtm_dst_len = dst ? prefixlen : 0;
+	nl_put(req, &rtm, sizeof(rtm));
+	if (dst)
+		nl_attr(req, RTA_DST, dst, sizeof(*dst));
+	nl_attr(req, RTA_GATEWAY, gw, sizeof(*gw));
+	if (oif)
+		nl_attr(req, RTA_OIF, &oif, sizeof(oif));
+}
+
+#define LINK_ADD_DOC    ".. py:function:: link_add(name, kind)\n"\
+                        "\n"\
+                        "create a network link, same as ``ip link add <name> type <kind>``\n"\
+                        "\n"\
+                        ":param str name: name of the new link\n"\
+                        ":param str kind: link type, e.g. ``bridge``\n"\
+                        ":return: None\n"\
+                        ":raises RuntimeError: if the link cannot be created\n"\
+                        "\n"
+
+static PyObject *
+_link_add(PyObject *self, PyObject *args) {
+	const char *name, *kind;
+	struct nl_req req;
+	struct ifinfomsg ifi = { .ifi_family = AF_UNSPEC };
+	struct rtattr *linkinfo;
+
+	if (!PyArg_ParseTuple(args, "ss", &name, &kind))
+		return NULL;
+
+	nl_init(&req, RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL);
+	nl_put(&req, &ifi, sizeof(ifi));
+	nl_attr(&req, IFLA_IFNAME, name, strlen(name) + 1);
+	linkinfo = nl_attr(&req, IFLA_LINKINFO, NULL, 0);
+	nl_attr(&req, IFLA_INFO_KIND, kind, strlen(kind));
+	nl_nest_end(&req, linkinfo);
+
+	return nl_result(&req);
+}
+
+#define VETH_ADD_DOC    ".. py:function:: veth_add(name, peer)\n"\
+                        "\n"\
+                        "create a veth pair, same as ``ip link add <name> type veth peer name <peer>``\n"\
+                        "\n"\
+                        ":param str name: name of the first end\n"\
+                        ":param str peer: name of the other end\n"\
+                        ":return: None\n"\
+                        ":raises RuntimeError: if the pair cannot be created\n"\
+                        "\n"
+
+static PyObject *
+_veth_add(PyObject *self, PyObject *args) {
+	const char *name, *peer;
+	struct nl_req req;
+	struct ifinfomsg ifi = { .ifi_family = AF_UNSPEC };
+	struct rtattr *linkinfo, *data, *peerinfo;
+
+	if (!PyArg_ParseTuple(args, "ss", &name, &peer))
+		return NULL;
+
+	nl_init(&req, RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL);
+	nl_put(&req, &ifi, sizeof(ifi));
+	nl_attr(&req, IFLA_IFNAME, name, strlen(name) + 1);
+	linkinfo = nl_attr(&req, IFLA_LINKINFO, NULL, 0);
+	nl_attr(&req, IFLA_INFO_KIND, "veth", strlen("veth"));
+	data = nl_attr(&req, IFLA_INFO_DATA, NULL, 0);
+	peerinfo = nl_attr(&req, VETH_INFO_PEER, NULL, 0);
+	nl_put(&req, &ifi, sizeof(ifi));
+	nl_attr(&req, IFLA_IFNAME, peer, strlen(peer) + 1);
+	nl_nest_end(&req, peerinfo);
+	nl_nest_end(&req, data);
+	nl_nest_end(&req, linkinfo);
+
+	return nl_result(&req);
+}
+
+#define LINK_DEL_DOC    ".. py:function:: link_del(name)\n"\
+                        "\n"\
+                        "delete a network link, same as ``ip link del <name>``\n"\
+                        "\n"\
+                        ":param str name: name of the link\n"\
+                        ":return: None\n"\
+                        ":raises RuntimeError: if the link cannot be deleted\n"\
+                        "\n"
+
+static PyObject *
+_link_del(PyObject *self, PyObject *args) {
+	const char *name;
+	struct nl_req req;
+	struct ifinfomsg ifi = { .ifi_family = AF_UNSPEC };
+
+	if (!PyArg_ParseTuple(args, "s", &name))
+		return NULL;
+
+	if ((ifi.ifi_index = nl_ifindex(name)) == 0)
+		return NULL;
+
+	nl_init(&req, RTM_DELLINK, 0);
+	nl_put(&req, &ifi, sizeof(ifi));
+
+	return nl_result(&req);
+}
+
+#define LINK_SET_UP_DOC ".. py:function:: link_set_up(name)\n"\
+                        "\n"\
+                        "bring a network link up, same as ``ip link set <name> up``\n"\
+                        "\n"\
+                        ":param str name: name of the link\n"\
+                        ":return: None\n"\
+                        ":raises RuntimeError: if the link cannot be brought up\n"\
+                        "\n"
+
+static PyObject *
+_link_set_up(PyObject *self, PyObject *args) {
+	const char *name;
+	unsigned int index;
+	struct nl_req req;
+
+	if (!PyArg_ParseTuple(args, "s", &name))
+		return NULL;
+
+	if ((index = nl_ifindex(name)) == 0)
+		return NULL;
+
+	nl_link_up_req(&req, index);
+
+	return nl_result(&req);
+}
+
+#define LINK_SET_NETNS_DOC  ".. py:function:: link_set_netns(name, pid)\n"\
+                            "\n"\
+                            "move a network link into the network namespace of a process,\n"\
+                            "same as ``ip link set <name> netns <pid>``\n"\
+                            "\n"\
+                            ":param str name: name of the link\n"\
+                            ":param int pid: process whose network namespace the link is moved to\n"\
+                            ":return: None\n"\
+                            ":raises RuntimeError: if the link cannot be moved\n"\
+                            "\n"
+
+static PyObject *
+_link_set_netns(PyObject *self, PyObject *args) {
+	const char *name;
+	unsigned int pid;
+	struct nl_req req;
+	struct ifinfomsg ifi = { .ifi_family = AF_UNSPEC };
+
+	if (!PyArg_ParseTuple(args, "sI", &name, &pid))
+		return NULL;
+
+	if ((ifi.ifi_index = nl_ifindex(name)) == 0)
+		return NULL;
+
+	nl_init(&req, RTM_NEWLINK, 0);
+	nl_put(&req, &ifi, sizeof(ifi));
+	nl_attr(&req, IFLA_NET_NS_PID, &pid, sizeof(pid));
+
+	return nl_result(&req);
+}
+
+#define LINK_SET_MASTER_DOC ".. py:function:: link_set_master(name, master)\n"\
+                            "\n"\
+                            "enslave a network link to a bridge, same as ``brctl addif <master> <name>``\n"\
+                            "\n"\
+                            ":param str name: name of the link\n"\
+                            ":param str master: name of the bridge\n"\
+                            ":return: None\n"\
+                            ":raises RuntimeError: if the link cannot be enslaved\n"\
+                            "\n"
+
+static PyObject *
+_link_set_master(PyObject *self, PyObject *args) {
+	const char *name, *master;
+	unsigned int master_index;
+	struct nl_req req;
+	struct ifinfomsg ifi = { .ifi_family = AF_UNSPEC };
+
+	if (!PyArg_ParseTuple(args, "ss", &name, &master))
+		return NULL;
+
+	if ((ifi.ifi_index = nl_ifindex(name)) == 0)
+		return NULL;
+	if ((master_index = nl_ifindex(master)) == 0)
+		return NULL;
+
+	nl_init(&req, RTM_NEWLINK, 0);
+	nl_put(&req, &ifi, sizeof(ifi));
+	nl_attr(&req, IFLA_MASTER, &master_index, sizeof(master_index));
+
+	return nl_result(&req);
+}
+
+#define ADDR_ADD_DOC    ".. py:function:: addr_add(name, address, prefixlen)\n"\
+                        "\n"\
+                        "add an IPv4 address to a network link,\n"\
+                        "same as ``ip addr add <address>/<prefixlen> dev <name>``\n"\
+                        "\n"\
+                        ":param str name: name of the link\n"\
+                        ":param str address: IPv4 address in dotted notation\n"\
+                        ":param int prefixlen: length of the network prefix\n"\
+                        ":return: None\n"\
+                        ":raises RuntimeError: if the address cannot be added\n"\
+                        "\n"
+
+static PyObject *
+_addr_add(PyObject *self, PyObject *args) {
+	const char *name, *address;
+	int prefixlen;
+	unsigned int index;
+	struct in_addr addr;
+	struct nl_req req;
+
+	if (!PyArg_ParseTuple(args, "ssi", &name, &address, &prefixlen))
+		return NULL;
+
+	if (inet_pton(AF_INET, address, &addr) != 1) {
+		PyErr_Format(PyExc_ValueError, "invalid IPv4 address: %s", address);
+		return NULL;
+	}
+
+	if ((index = nl_ifindex(name)) == 0)
+		return NULL;
+
+	nl_addr_add_req(&req, index, &addr, prefixlen);
+
+	return nl_result(&req);
+}
+
+#define ROUTE_ADD_DOC   ".. py:function:: route_add(dst, prefixlen, gateway, name)\n"\
+                        "\n"\
+                        "add an IPv4 route, same as ``ip route add <dst>/<prefixlen> via <gateway> dev <name>``\n"\
+                        "\n"\
+                        ":param str dst: destination network, ``None`` for the default route\n"\
+                        ":param int prefixlen: length of the destination prefix\n"\
+                        ":param str gateway: IPv4 address of the next hop\n"\
+                        ":param str name: name of the outgoing link\n"\
+                        ":return: None\n"\
+                        ":raises RuntimeError: if the route cannot be added\n"\
+                        "\n"
+
+static PyObject *
+_route_add(PyObject *self, PyObject *args) {
+	const char *dst, *gateway, *name;
+	int prefixlen;
+	unsigned int oif = 0;
+	struct in_addr dst_addr, gw_addr;
+	struct nl_req req;
+
+	if (!PyArg_ParseTuple(args, "zisz", &dst, &prefixlen, &gateway, &name))
+		return NULL;
+
+	if ((dst && inet_pton(AF_INET, dst, &dst_addr) != 1) || inet_pton(AF_INET, gateway, &gw_addr) != 1) {
+		PyErr_Format(PyExc_ValueError, "invalid IPv4 route: %s via %s", dst ? dst : "default", gateway);
+		return NULL;
+	}
+
+	if (name && (oif = nl_ifindex(name)) == 0)
+		return NULL;
+
+	nl_route_add_req(&req, dst ? &dst_addr : NULL, prefixlen, &gw_addr, oif);
+
+	return nl_result(&req);
+}
+
+/*
+ * spawn(): run the whole container init in C between clone and exec.
+ * The spec is converted to plain C data in the parent before cloning, so
+ * the child never touches the interpreter.
+ */
+
+enum spawn_op {
+	SPAWN_MOUNT,
+	SPAWN_MKDIR,
+	SPAWN_MKNOD,
+	SPAWN_SYMLINK,
+};
+
+struct spawn_step {
+	int op;
+	const char *path;
+	const char *source;
+	const char *fstype;
+	const char *data;
+	unsigned long flags;
+	unsigned int mode;
+	unsigned int major, minor;
+};
+
+struct spawn_spec {
+	char **argv;
+	const char *root;
+	const char *hostname;
+	int start_fd, status_fd;
+	int close_fds[2];
+	int stdio[3];
+	const char *stdin_path, *stdout_path;
+	const char *veth;
+	struct in_addr address, gateway;
+	int prefixlen;
+	struct spawn_step *steps;
+	Py_ssize_t nsteps;
+};
+
+static const char *spawn_op_names[] = { "mount", "mkdir", "mknod", "symlink" };
+
+/* report the failed stage in the json format read by minidocker.wait_exec() */
+static void spawn_fail(struct spawn_spec *spec, const char *stage) {
+	int err = errno;
+
+	dprintf(spec->status_fd, "{\"stage\": \"%s\", \"error\": \"%s\", \"errno\": %d}",
+	        stage, strerror(err), err);
+	_exit(1);
+}
+
+static int spawn_step(struct spawn_step *step) {
+	mode_t old_umask;
+	int ret;
+
+	switch (step->op) {
+	case SPAWN_MOUNT:
+		return mount(step->source, step->path, step->fstype, step->flags, step->data);
+	case SPAWN_MKDIR:
+		if (mkdir(step->path, step->mode) == -1 && errno != EEXIST)
+			return -1;
+		return 0;
+	case SPAWN_MKNOD:
+		old_umask = umask(0);
+		ret = mknod(step->path, step->mode, makedev(step->major, step->minor));
+		umask(old_umask);
+		return ret;
+	case SPAWN_SYMLINK:
+		return symlink(step->source, step->path);
+	}
+	errno = EINVAL;
+	return -1;
+}
+
+static void spawn_child(struct spawn_spec *spec) {
+	unsigned int index;
+	struct nl_req req;
+	char start;
+	int i, fd;
+
+	for (i = 0; i < 2; i++)
+		if (spec->close_fds[i] >= 0)
+			close(spec->close_fds[i]);
+
+	for (i = 0; i < 3; i++)
+		if (spec->stdio[i] >= 0 && dup2(spec->stdio[i], i) == -1)
+			spawn_fail(spec, "stdio");
+	if (spec->stdin_path) {
+		if ((fd = open(spec->stdin_path, O_RDONLY)) == -1 || dup2(fd, 0) == -1)
+			spawn_fail(spec, "stdio");
+	}
+	if (spec->stdout_path) {
+		if ((fd = open(spec->stdout_path, O_WRONLY)) == -1 || dup2(fd, 1) == -1 || dup2(fd, 2) == -1)
+			spawn_fail(spec, "stdio");
+	}
+
+	/* the host closes the pipe without writing if it failed to set us up */
+	if (read(spec->start_fd, &start, 1) != 1)
+		_exit(1);
+	close(spec->start_fd);
+
+	if (spec->veth) {
+		if ((index = if_nametoindex(spec->veth)) == 0)
+			spawn_fail(spec, "vnet");
+		nl_addr_add_req(&req, index, &spec->address, spec->prefixlen);
+		if (nl_talk(&req) == -1)
+			spawn_fail(spec, "vnet");
+		nl_link_up_req(&req, index);
+		if (nl_talk(&req) == -1)
+			spawn_fail(spec, "vnet");
+		nl_route_add_req(&req, NULL, 0, &spec->gateway, index);
+		if (nl_talk(&req) == -1)
+			spawn_fail(spec, "vnet");
+	}
+
+	if (spec->hostname && sethostname(spec->hostname, strlen(spec->hostname)) == -1)
+		spawn_fail(spec, "hostname");
+
+	for (i = 0; i < spec->nsteps; i++)
+		if (spawn_step(&spec->steps[i]) == -1)
+			spawn_fail(spec, spawn_op_names[spec->steps[i].op]);
+
+	/* the old root ends up stacked on the new one, nothing is created in
+	 * root so it may be read-only */
+	if (chdir(spec->root) == -1 || syscall(SYS_pivot_root, ".", ".") == -1)
+		spawn_fail(spec, "pivot_root");
+	if (umount2(".", MNT_DETACH) == -1 || chdir("/") == -1)
+		spawn_fail(spec, "pivot_root");
+
+	/* status_fd is close-on-exec, the host sees EOF once execv succeeds */
+	execv(spec->argv[0], spec->argv);
+	spawn_fail(spec, "exec");
+}
+
+/* borrowed utf-8 string of spec[key], NULL if missing or None */
+static int spec_str(PyObject *spec, const char *key, const char **out, int required) {
+	PyObject *value = PyDict_GetItemString(spec, key);
+
+	*out = NULL;
+	if (value == NULL || value == Py_None) {
+		if (required) {
+			PyErr_Format(PyExc_KeyError, "spawn spec needs '%s'", key);
+			return -1;
+		}
+		return 0;
+	}
+	if ((*out = PyUnicode_AsUTF8(value)) == NULL)
+		return -1;
+	return 0;
+}
+
+static int spec_fds(PyObject *spec, const char *key, int *fds, Py_ssize_t n) {
+	PyObject *value = PyDict_GetItemString(spec, key), *seq;
+	Py_ssize_t i;
+
+	for (i = 0; i < n; i++)
+		fds[i] = -1;
+	if (value == NULL || value == Py_None)
+		return 0;
+
+	if ((seq = PySequence_Fast(value, "spawn spec fds must be a sequence")) == NULL)
+		return -1;
+	if (PySequence_Fast_GET_SIZE(seq) != n) {
+		PyErr_Format(PyExc_ValueError, "spawn spec '%s' needs %zd fds", key, n);
+		Py_DECREF(seq);
+		return -1;
+	}
+	for (i = 0; i < n; i++) {
+		fds[i] = PyLong_AsLong(PySequence_Fast_GET_ITEM(seq, i));
+		if (fds[i] == -1 && PyErr_Occurred()) {
+			Py_DECREF(seq);
+			return -1;
+		}
+	}
+	Py_DECREF(seq);
+	return 0;
+}
+
+static int spec_step(PyObject *item, struct spawn_step *step) {
+	const char *op;
+
+	memset(step, 0, sizeof(*step));
+	if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) < 1) {
+		PyErr_SetString(PyExc_TypeError, "spawn steps must be tuples");
+		return -1;
+	}
+	if ((op = PyUnicode_AsUTF8(PyTuple_GET_ITEM(item, 0))) == NULL)
+		return -1;
+
+	if (strcmp(op, "mount") == 0) {
+		step->op = SPAWN_MOUNT;
+		return PyArg_ParseTuple(item, "szszkz", &op, &step->source, &step->path, &step->fstype,
+		                        &step->flags, &step->data) ? 0 : -1;
+	} else if (strcmp(op, "mkdir") == 0) {
+		step->op = SPAWN_MKDIR;
+		return PyArg_ParseTuple(item, "ssI", &op, &step->path, &step->mode) ? 0 : -1;
+	} else if (strcmp(op, "mknod") == 0) {
+		step->op = SPAWN_MKNOD;
+		return PyArg_ParseTuple(item, "ssIII", &op, &step->path, &step->mode,
+		                        &step->major, &step->minor) ? 0 : -1;
+	} else if (strcmp(op, "symlink") == 0) {
+		step->op = SPAWN_SYMLINK;
+		return PyArg_ParseTuple(item, "sss", &op, &step->source, &step->path) ? 0 : -1;
+	}
+
+	PyErr_Format(PyExc_ValueError, "unknown spawn step '%s'", op);
+	return -1;
+}
+
+static int spec_parse(PyObject *spec, struct spawn_spec *out) {
+	PyObject *argv, *steps, *net;
+	Py_ssize_t i, n;
+	int sync[2];
+	const char *address, *gateway;
+
+	memset(out, 0, sizeof(*out));
+	if (!PyDict_Check(spec)) {
+		PyErr_SetString(PyExc_TypeError, "spawn spec must be a dict");
+		return -1;
+	}
+
+	if (spec_str(spec, "root", &out->root, 1) == -1 ||
+	    spec_str(spec, "hostname", &out->hostname, 0) == -1 ||
+	    spec_str(spec, "stdin_path", &out->stdin_path, 0) == -1 ||
+	    spec_str(spec, "stdout_path", &out->stdout_path, 0) == -1)
+		return -1;
+
+	if (spec_fds(spec, "sync", sync, 2) == -1 ||
+	    spec_fds(spec, "close_fds", out->close_fds, 2) == -1 ||
+	    spec_fds(spec, "stdio", out->stdio, 3) == -1)
+		return -1;
+	out->start_fd = sync[0];
+	out->status_fd = sync[1];
+	if (out->start_fd < 0 || out->status_fd < 0) {
+		PyErr_SetString(PyExc_KeyError, "spawn spec needs 'sync'");
+		return -1;
+	}
+
+	net = PyDict_GetItemString(spec, "net");
+	if (net != NULL && net != Py_None) {
+		if (!PyArg_ParseTuple(net, "ssis", &out->veth, &address, &out->prefixlen, &gateway))
+			return -1;
+		if (inet_pton(AF_INET, address, &out->address) != 1 ||
+		    inet_pton(AF_INET, gateway, &out->gateway) != 1) {
+			PyErr_Format(PyExc_ValueError, "invalid IPv4 address: %s via %s", address, gateway);
+			return -1;
+		}
+	}
+
+	argv = PyDict_GetItemString(spec, "argv");
+	if (argv == NULL || !PyList_Check(argv) || PyList_GET_SIZE(argv) == 0) {
+		PyErr_SetString(PyExc_ValueError, "spawn spec needs a non-empty 'argv' list");
+		return -1;
+	}
+	n = PyList_GET_SIZE(argv);
+	if ((out->argv = calloc(n + 1, sizeof(char *))) == NULL) {
+		PyErr_NoMemory();
+		return -1;
+	}
+	for (i = 0; i < n; i++)
+		if ((out->argv[i] = (char *)PyUnicode_AsUTF8(PyList_GET_ITEM(argv, i))) == NULL)
+			return -1;
+
+	steps = PyDict_GetItemString(spec, "steps");
+	if (steps == NULL || steps == Py_None)
+		return 0;
+	if (!PyList_Check(steps)) {
+		PyErr_SetString(PyExc_TypeError, "spawn spec 'steps' must be a list");
+		return -1;
+	}
+	out->nsteps = PyList_GET_SIZE(steps);
+	if ((out->steps = calloc(out->nsteps + 1, sizeof(struct spawn_step))) == NULL) {
+		PyErr_NoMemory();
+		return -1;
+	}
+	for (i = 0; i < out->nsteps; i++)
+		if (spec_step(PyList_GET_ITEM(steps, i), &out->steps[i]) == -1)
+			return -1;
+
+	return 0;
+}
+
+#define SPAWN_DOC   ".. py:function:: spawn(spec, flags, cgroup_fd=-1)\n"\
+                    "\n"\
+                    "clone a container and run its init sequence in C up to execv\n"\
+                    "\n"\
+                    ":param dict spec: what the child does before exec, see below\n"\
+                    ":param int flags: combination (using ``|``) of clone flags, see :py:func:`clone`\n"\
+                    ":param int cgroup_fd: cgroup v2 directory fd the child is created in, see\n"\
+                    "                      :py:func:`clone3`\n"\
+                    ":return: tuple of the child pid and a pidfd referring to the child\n"\
+                    ":raises RuntimeError: if clone3 fails\n"\
+                    "\n"\
+                    "The child closes ``close_fds``, sets up ``stdio`` (3 fds) or opens ``stdin_path``\n"\
+                    "and ``stdout_path``, then blocks until a byte arrives on ``sync[0]``. It then\n"\
+                    "configures ``net`` (``(veth, address, prefixlen, gateway)``), sets ``hostname``, runs\n"\
+                    "``steps`` in order, pivots into ``root`` and execs ``argv``. Steps are tuples:\n"\
+                    "\n"\
+                    "* ``('mount', source, target, fstype, flags, data)``\n"\
+                    "* ``('mkdir', path, mode)``\n"\
+                    "* ``('mknod', path, mode, major, minor)``\n"\
+                    "* ``('symlink', target, path)``\n"\
+                    "\n"\
+                    "If a stage fails the child writes a json error to ``sync[1]`` and exits;\n"\
+                    "``sync[1]`` is close-on-exec, so EOF on it means execv succeeded.\n"
+
+static PyObject *
+_spawn(PyObject *self, PyObject *args) {
+	PyObject *spec;
+	unsigned long long flags;
+	int cgroup_fd = -1, pidfd = -1, saved_errno;
+	struct spawn_spec cspec;
+	struct clone3_args cl_args;
+	long child_pid;
+
+	if (!PyArg_ParseTuple(args, "OK|i", &spec, &flags, &cgroup_fd))
+		return NULL;
+
+	if (spec_parse(spec, &cspec) == -1) {
+		free(cspec.argv);
+		free(cspec.steps);
+		return NULL;
+	}
+
+	memset(&cl_args, 0, sizeof(cl_args));
+	cl_args.flags = flags | CLONE_PIDFD;
+	cl_args.pidfd = (uint64_t)(uintptr_t)&pidfd;
+	cl_args.exit_signal = SIGCHLD;
+	if (cgroup_fd >= 0) {
+		cl_args.flags |= CLONE_INTO_CGROUP;
+		cl_args.cgroup = cgroup_fd;
+	}
+
+	child_pid = syscall(SYS_clone3, &cl_args, sizeof(cl_args));
+	if (child_pid == 0)
+		spawn_child(&cspec);
+	saved_errno = errno;
+
+	free(cspec.argv);
+	free(cspec.steps);
+
+	if (child_pid == -1) {
+		errno = saved_errno;
+		PyErr_SetFromErrno(PyExc_RuntimeError);
+		return NULL;
+	}
+	return Py_BuildValue("(li)", child_pid, pidfd);
+}
+
 static PyMethodDef LinuxMethods[] = {
 	{"pivot_root", pivot_root, METH_VARARGS, PIVOT_ROOT_DOC},
 	{"unshare", _unshare, METH_VARARGS, UNSHARE_DOC},
+	{"ioprio_set", _ioprio_set, METH_VARARGS, IOPRIO_SET_DOC},
 	{"setns", _setns, METH_VARARGS, SETNS_DOC},
 	{"clone", _clone, METH_VARARGS, CLONE_DOC},
+	{"clone3", _clone3, METH_VARARGS, CLONE3_DOC},
+	{"spawn", _spawn, METH_VARARGS, SPAWN_DOC},
 	{"sethostname", _sethostname, METH_VARARGS, SETHOSTNAME_DOC},
 	{"mount", _mount, METH_VARARGS, MOUNT_DOC},
 	{"umount", _umount, METH_VARARGS, UMOUNT_DOC},
 	{"umount2", _umount2, METH_VARARGS, UMOUNT2_DOC},
+	{"link_add", _link_add, METH_VARARGS, LINK_ADD_DOC},
+	{"veth_add", _veth_add, METH_VARARGS, VETH_ADD_DOC},
+	{"link_del", _link_del, METH_VARARGS, LINK_DEL_DOC},
+	{"link_set_up", _link_set_up, METH_VARARGS, LINK_SET_UP_DOC},
+	{"link_set_netns", _link_set_netns, METH_VARARGS, LINK_SET_NETNS_DOC},
+	{"link_set_master", _link_set_master, METH_VARARGS, LINK_SET_MASTER_DOC},
+	{"addr_add", _addr_add, METH_VARARGS, ADDR_ADD_DOC},
+	{"route_add", _route_add, METH_VARARGS, ROUTE_ADD_DOC},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -353,6 +1257,15 @@ PyInit_linux(void)
 	PyModule_AddIntConstant(module, "MS_NOUSER", MS_NOUSER);
 	PyModule_AddIntConstant(module, "MNT_DETACH", MNT_DETACH);             /* Just detach from the tree.  */
 	PyModule_AddIntConstant(module, "MS_MGC_VAL", MS_MGC_VAL);
+
+	// ioprio constants, from linux/ioprio.h
+	PyModule_AddIntConstant(module, "IOPRIO_WHO_PROCESS", 1);
+	PyModule_AddIntConstant(module, "IOPRIO_WHO_PGRP", 2);
+	PyModule_AddIntConstant(module, "IOPRIO_WHO_USER", 3);
+	PyModule_AddIntConstant(module, "IOPRIO_CLASS_SHIFT", 13);
+	PyModule_AddIntConstant(module, "IOPRIO_CLASS_RT", 1);
+	PyModule_AddIntConstant(module, "IOPRIO_CLASS_BE", 2);
+	PyModule_AddIntConstant(module, "IOPRIO_CLASS_IDLE", 3);
 	
 	return module;
 }
@@ -0,0 +1,533 @@
+import click
+import ipaddress
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def timeit(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+def report(name, seconds):
+    print(f"{name:<40}{seconds * 1e6:>12.1f} us")
+
+def report_rate(name, seconds):
+    print(f"{name:<40}{1 / seconds:>12.1f} ops/s")
+
+@click.group()
+def main():
+    pass
+
+@main.command()
+@click.option('--live', help='Number of live containers to reach', default=16000)
+@click.option('--step', help='Report every step allocations', default=2000)
+@click.option('--subnet', help='Subnet to allocate from', default='172.18.0.0/16')
+def ipam(live, step, subnet):
+    import ipam
+
+    subnet = ipaddress.IPv4Network(subnet)
+    with tempfile.TemporaryDirectory() as tmp:
+        ipam.DEFAULT_IPAM_DIR = tmp
+
+        # old code: list(VBRIDGE_SUBNET.hosts())[nth]
+        report("hosts() list lookup", timeit(lambda: list(subnet.hosts())[1], 10))
+
+        print("alloc+release cycle with N live addresses")
+        allocated = 0
+        while allocated < live:
+            for _ in range(step):
+                ipam.ipam_alloc(subnet)
+            allocated += step
+
+            def cycle():
+                ipam.ipam_release(subnet, ipam.ipam_alloc(subnet))
+            report(f"  N={allocated}", timeit(cycle, 1000))
+
+@main.command()
+@click.option('--rounds', help='Number of veth pairs to set up', default=200)
+def vnet(rounds):
+    import linux
+    from minidocker import run_cmd
+
+    # work in a scratch network namespace, the host is left untouched
+    linux.unshare(linux.CLONE_NEWNET)
+    linux.link_add("benchbr0", "bridge")
+    linux.link_set_up("benchbr0")
+
+    def setup_fork():
+        run_cmd("ip link add bva type veth peer name bvb")
+        run_cmd("ip link set bvb master benchbr0")
+        run_cmd("ip link set bvb up")
+        run_cmd("ip addr add 10.77.0.2/16 dev bva")
+        run_cmd("ip link set bva up")
+        run_cmd("ip route add 10.78.0.0/16 via 10.77.0.1 dev bva")
+        run_cmd("ip link del bva")
+
+    def setup_netlink():
+        linux.veth_add("bva", "bvb")
+        linux.link_set_master("bvb", "benchbr0")
+        linux.link_set_up("bvb")
+        linux.addr_add("bva", "10.77.0.2", 16)
+        linux.link_set_up("bva")
+        linux.route_add("10.78.0.0", 16, "10.77.0.1", "bva")
+        linux.link_del("bva")
+
+    print("veth pair setup and teardown")
+    report("  ip/brctl subprocesses", timeit(setup_fork, rounds))
+    report("  netlink", timeit(setup_netlink, rounds))
+
+@main.command()
+@click.option('--rounds', help='Number of calls per operation', default=50)
+@click.option('--image-name', '-i', help='Also benchmark run with this image', default=None)
+def daemon(rounds, image_name):
+    from rpc import daemon_request
+
+    if daemon_request('ps') is None:
+        raise click.ClickException("minidockerd is not running, start it with python minidockerd.py")
+
+    # a socket that does not exist makes the cli run everything itself
+    env = dict(os.environ, MINIDOCKERD_SOCKET="/nonexistent")
+
+    def cli(*args):
+        subprocess.run([sys.executable, "minidocker.py", *args], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    def through_daemon(*args):
+        subprocess.run([sys.executable, "minidocker.py", *args], check=True,
+                       stdout=subprocess.DEVNULL)
+
+    print("ps")
+    report_rate("  one-shot cli", timeit(lambda: cli("ps"), rounds))
+    report_rate("  cli through minidockerd", timeit(lambda: through_daemon("ps"), rounds))
+    report_rate("  minidockerd request", timeit(lambda: daemon_request('ps'), rounds))
+
+    if image_name is None:
+        return
+
+    print(f"run -i {image_name} /bin/true")
+    run_args = ("run", "-i", image_name, "/bin/true")
+    report_rate("  one-shot cli", timeit(lambda: cli(*run_args), rounds))
+    report_rate("  cli through minidockerd", timeit(lambda: through_daemon(*run_args), rounds))
+    report_rate("  minidockerd request", timeit(lambda: daemon_request(
+        'run', command=["/bin/true"], image_name=image_name, cpu_shares=0,
+        mlimit=None, mslimit=None, daemon=False), rounds))
+
+@main.command()
+@click.option('--rounds', help='Number of containers to start per path', default=100)
+@click.option('--image-name', '-i', help='Image to use as the root fs', default='ubuntu')
+@click.option('--rootfs', help='Use this directory as the root fs instead of an image', default=None)
+def spawn(rounds, image_name, rootfs):
+    import linux
+    import minidocker as md
+
+    if rootfs is None:
+        rootfs = md.get_image_root(image_name, md.IMAGE_BASE_DIR)
+    rootfs = os.path.abspath(rootfs)
+
+    # scratch mount and network namespaces, pivot_root needs rootfs to be a mount point
+    linux.unshare(linux.CLONE_NEWNS | linux.CLONE_NEWNET)
+    linux.mount(None, "/", None, linux.MS_PRIVATE | linux.MS_REC, '')
+    linux.mount(rootfs, rootfs, None, linux.MS_BIND, '')
+    # the containers' /dev comes from the template, on a fresh host this
+    # one goes away with the namespace
+    if not md.dev_template_ready():
+        md.build_dev_template()
+    linux.link_add(md.VBRIDGE_NAME, "bridge")
+    linux.addr_add(md.VBRIDGE_NAME, str(md.VBRIDGE_SUBNET_GATEWAY), md.VBRIDGE_SUBNET_BITS)
+    linux.link_set_up(md.VBRIDGE_NAME)
+
+    flags = linux.CLONE_NEWPID | linux.CLONE_NEWNS | linux.CLONE_NEWUTS | linux.CLONE_NEWNET
+    ipaddr = md.get_next_vnet_ip(2)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    # veths of exited containers go away asynchronously, don't reuse names
+    veth_ids = itertools.count()
+
+    def start(native):
+        veth_inside, veth_outside = md.veth_pair_name(next(veth_ids))
+        start_r, start_w = os.pipe()
+        status_r, status_w = os.pipe()
+        sync = (start_r, start_w, status_r, status_w)
+        cb_args = (["/bin/true"], "bench", rootfs, ipaddr, md.VBRIDGE_SUBNET_GATEWAY, veth_inside,
+                   False, [devnull] * 3, sync)
+        clone_time = time.perf_counter()
+        if native:
+            pid, pidfd = linux.spawn(md.container_spec(*cb_args), flags)
+        else:
+            pid, pidfd = linux.clone3(md.contain, flags, cb_args)
+        os.close(start_r)
+        os.close(status_w)
+
+        linux.veth_add(veth_inside, veth_outside)
+        linux.link_set_netns(veth_inside, pid)
+        linux.link_set_master(veth_outside, md.VBRIDGE_NAME)
+        linux.link_set_up(veth_outside)
+        os.write(start_w, md.START_BYTE)
+        os.close(start_w)
+
+        exec_time = md.wait_exec(status_r, clone_time)
+        os.close(status_r)
+        os.close(pidfd)
+        os.waitpid(pid, 0)
+        return exec_time
+
+    print("time from clone to exec, veth setup included")
+    for name, native in (("contain()", False), ("linux.spawn", True)):
+        times = sorted(start(native) for _ in range(rounds))
+        report(f"  {name} p50", times[len(times) // 2])
+        report(f"  {name} p99", times[int(len(times) * 0.99)])
+
+def make_tar(path, nfiles, total):
+    # nfiles files of about total bytes in 64 dirs, plus symlinks and hardlinks
+    import io
+    import random
+    import tarfile
+
+    rand = random.Random(0)
+    # random text over 16 letters, compresses about 2:1 and leaves nothing
+    # for a compressor to share between files
+    letters = bytes(b"etaoinshrdlucmfw"[i % 16] for i in range(256))
+    size = total // nfiles
+    with tarfile.open(path, 'w') as tf:
+        for d in range(64):
+            info = tarfile.TarInfo(f"d{d:02}")
+            info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0o755, 1000000000 + d
+            tf.addfile(info)
+        for i in range(nfiles):
+            name = f"d{i % 64:02}/f{i}"
+            n = rand.randint(0, 2 * size)
+            data = rand.randbytes(n).translate(letters)
+            info = tarfile.TarInfo(name)
+            info.size, info.mode, info.mtime = n, rand.choice((0o644, 0o755, 0o600)), 1200000000 + i
+            info.uid, info.gid = rand.choice(((0, 0), (1000, 1000)))
+            tf.addfile(info, io.BytesIO(data))
+            if i % 50 == 0:
+                link = tarfile.TarInfo(f"{name}.sym")
+                link.type, link.linkname = tarfile.SYMTYPE, f"f{i}"
+                tf.addfile(link)
+                link = tarfile.TarInfo(f"{name}.lnk")
+                link.type, link.linkname = tarfile.LNKTYPE, name
+                tf.addfile(link)
+
+def tree_state(root, archived):
+    # everything extraction is expected to reproduce, hardlinks as shared inodes.
+    # Parents missing from the archive get the time of extraction as mtime.
+    import hashlib
+    import stat
+
+    state = {}
+    inodes = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            entry = [stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid]
+            if stat.S_ISLNK(st.st_mode):
+                entry.append(os.readlink(path))
+            elif os.path.relpath(path, root) in archived:
+                entry.append(st.st_mtime_ns)
+            if stat.S_ISREG(st.st_mode):
+                body = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    while chunk := f.read(1 << 20):
+                        body.update(chunk)
+                entry.append(body.hexdigest())
+                entry.append(inodes.setdefault(st.st_ino, os.path.relpath(path, root)))
+            state[os.path.relpath(path, root)] = entry
+    return state
+
+@main.command()
+@click.option('--files', help='Number of files in the generated image', default=4000)
+@click.option('--size', help='Total size of the generated image in MiB', default=2048)
+@click.option('--image', help='Use this tarball instead of a generated one', default=None)
+@click.option('--workers', help='Writer threads of the parallel extractor', default=None, type=int)
+def extract(files, size, image, workers):
+    import shutil
+    import tarfile
+    import images
+
+    with tempfile.TemporaryDirectory(dir=".") as tmp:
+        if image is None:
+            image = os.path.join(tmp, "image.tar")
+            make_tar(image, files, size << 20)
+        nbytes = os.path.getsize(image)
+
+        def old(dest):
+            with tarfile.open(image) as tf:
+                tf.extractall(dest, filter=images.nodevs)
+
+        def hashed(dest):
+            # what the layer store did before, the digest comes with the read
+            with open(image, 'rb') as f:
+                reader = images.HashReader(f)
+                with tarfile.open(fileobj=reader, mode='r|') as tf:
+                    tf.extractall(dest, filter=images.nodevs)
+
+        def new(dest):
+            with open(image, 'rb') as f:
+                images.extract_tar(f, dest, workers or images.EXTRACT_WORKERS)
+
+        print(f"extract {nbytes >> 20} MiB, writes included up to the final sync")
+        roots = []
+        for name, fn in (("tarfile.extractall", old), ("extractall on a hashed stream", hashed),
+                         ("parallel extract_tar", new)):
+            dest = os.path.join(tmp, name)
+            os.mkdir(dest)
+            os.sync()
+            start = time.perf_counter()
+            fn(dest)
+            os.sync()
+            seconds = time.perf_counter() - start
+            print(f"  {name:<38}{seconds:>12.2f} s{nbytes / seconds / (1 << 20):>10.1f} MiB/s")
+            roots.append(dest)
+
+        with tarfile.open(image) as tf:
+            archived = {os.path.normpath(name) for name in tf.getnames()}
+        states = [tree_state(root, archived) for root in roots]
+        if any(state != states[0] for state in states):
+            raise click.ClickException("extracted trees differ")
+        print("  trees are identical")
+        for root in roots:
+            shutil.rmtree(root)
+
+@main.command()
+@click.option('--files', help='Number of files in the generated image', default=2000)
+@click.option('--size', help='Total size of the generated image in MiB', default=256)
+@click.option('--image', help='Use this tarball instead of a generated one', default=None)
+@click.option('--codecs', help='Codecs to compare', default='gzip,xz,bz2')
+def decompress(files, size, image, codecs):
+    import bz2
+    import gzip
+    import lzma
+    import shutil
+    import images
+
+    openers = {'gzip': gzip.open, 'xz': lzma.open, 'bz2': bz2.open}
+    with tempfile.TemporaryDirectory(dir=".") as tmp:
+        if image is None:
+            image = os.path.join(tmp, "image.tar")
+            make_tar(image, files, size << 20)
+        nbytes = os.path.getsize(image)
+        print(f"extract a {nbytes >> 20} MiB tar, throughput of uncompressed data")
+
+        def rate(seconds):
+            return f"{nbytes / seconds / (1 << 20):>10.1f} MiB/s"
+
+        for codec in codecs.split(','):
+            path = os.path.join(tmp, "image.tar." + codec)
+            with open(image, 'rb') as src, openers[codec](path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            print(f"  {codec}, {os.path.getsize(path) * 100 // nbytes}% of the tar")
+
+            def inflate():
+                with images.open_image(path) as (_, f):
+                    while f.read(1 << 20):
+                        pass
+
+            def inline(dest):
+                # the decompressor runs in the extracting thread
+                with openers[codec](path, 'rb') as f:
+                    images.extract_tar(f, dest)
+
+            def pipelined(dest):
+                with images.open_image(path) as (_, f):
+                    images.extract_tar(f, dest)
+
+            start = time.perf_counter()
+            inflate()
+            print(f"    {'inflate only':<36}{rate(time.perf_counter() - start)}")
+            for name, fn in (("inflate in the extracting thread", inline),
+                             ("inflate thread + bounded queue", pipelined)):
+                dest = os.path.join(tmp, "root")
+                os.mkdir(dest)
+                start = time.perf_counter()
+                fn(dest)
+                os.sync()
+                print(f"    {name:<36}{rate(time.perf_counter() - start)}")
+                shutil.rmtree(dest)
+            os.remove(path)
+
+@main.command()
+@click.option('--rounds', help='Number of snapshots per driver', default=20)
+@click.option('--image-name', '-i', help='Snapshot this image instead of a generated tree', default=None)
+@click.option('--files', help='Number of files in the generated tree', default=2000)
+@click.option('--copy-up', help='Size in MiB of the file written into every snapshot', default=64)
+def snapshot(rounds, image_name, files, copy_up):
+    import shutil
+    import linux
+    import minidocker as md
+
+    # scratch mount namespace, every snapshot mount goes away with us
+    linux.unshare(linux.CLONE_NEWNS)
+    linux.mount(None, "/", None, linux.MS_PRIVATE | linux.MS_REC, '')
+    os.makedirs(md.CONTAINER_BASE_DIR, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(prefix=".bench-", dir=md.CONTAINER_BASE_DIR) as tmp:
+        # a copy of its own, the copy-up file is added to it
+        image = os.path.join(tmp, "image")
+        if image_name is None:
+            for i in range(files):
+                d = os.path.join(image, f"d{i % 64:02}")
+                os.makedirs(d, exist_ok=True)
+                with open(os.path.join(d, f"f{i}"), 'wb') as f:
+                    f.write(os.urandom(4096))
+        else:
+            shutil.copytree(md.get_image_root(image_name, md.IMAGE_BASE_DIR), image, symlinks=True)
+        big = "bench-copy-up"
+        with open(os.path.join(image, big), 'wb') as f:
+            for _ in range(copy_up):
+                f.write(os.urandom(1 << 20))
+        os.sync()
+
+        print(f"snapshot create, then write 4 KiB into a {copy_up} MiB file")
+        for driver in md.SNAPSHOT_DRIVERS:
+            creates, writes = [], []
+            for r in range(rounds):
+                container = os.path.join(tmp, f"{driver}{r}")
+                rw, workdir, rootfs = (os.path.join(container, d) for d in ("rw", "workdir", "rootfs"))
+                for d in (rw, workdir, rootfs):
+                    os.makedirs(d)
+                try:
+                    start = time.perf_counter()
+                    try:
+                        md.create_snapshot(driver, [image], rw, workdir, rootfs)
+                    except (OSError, RuntimeError) as e:
+                        print(f"  {driver}: not supported here ({e})")
+                        break
+                    creates.append(time.perf_counter() - start)
+
+                    # the hardlink farm is read-only, nothing to copy up
+                    if os.statvfs(rootfs).f_flag & os.ST_RDONLY:
+                        continue
+                    start = time.perf_counter()
+                    with open(os.path.join(rootfs, big), 'r+b') as f:
+                        f.write(b'x' * 4096)
+                    writes.append(time.perf_counter() - start)
+                finally:
+                    # unmounted even if creating it failed halfway
+                    md.remove_snapshot(container)
+            if creates:
+                creates.sort()
+                writes.sort()
+                report(f"  {driver} create p50", creates[len(creates) // 2])
+                if writes:
+                    report(f"  {driver} first write p50", writes[len(writes) // 2])
+                else:
+                    print(f"{f'  {driver} first write p50':<40}{'n/a':>12} (read-only)")
+
+@main.command('exec')
+@click.option('--rounds', help='Number of execs per path', default=200)
+@click.option('--image-name', '-i', help='Image of the container to exec into', default='ubuntu')
+@click.option('--command', help='Command to exec', default='/bin/true')
+def exec_latency(rounds, image_name, command):
+    import contextlib
+    import io
+    import minidocker as md
+
+    # a container that stays up for the whole benchmark
+    cid, pid, _, pidfd = md.launch_container(["/bin/sleep", "3600"], image_name, 0, None, None, False)
+    devnull = os.open(os.devnull, os.O_RDWR)
+
+    def mount_table():
+        with open(f"/proc/{pid}/mountinfo") as f:
+            return f.read().splitlines()
+
+    def clone_exec():
+        with contextlib.redirect_stdout(io.StringIO()):
+            exec_pid, exec_pidfd = md.launch_exec([command], cid, [devnull] * 3)
+        os.close(exec_pidfd)
+        _, status = os.waitpid(exec_pid, 0)
+        return os.waitstatus_to_exitcode(status)
+
+    def helper_exec():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return md.helper_exec([command], cid, [devnull] * 3)[1]
+
+    try:
+        before = mount_table()
+        # the helper is started outside of the measurement
+        helper_exec()
+        print(f"exec {command} into a running container, start to exit")
+        for name, fn in (("clone3 from the host", clone_exec), ("exec helper", helper_exec)):
+            times = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                status = fn()
+                times.append(time.perf_counter() - start)
+                if status != 0:
+                    raise click.ClickException(f"{command} exited with status {status}")
+            report_rate(f"  {name}", sum(times) / len(times))
+            times.sort()
+            report(f"  {name} p50", times[len(times) // 2])
+            report(f"  {name} p99", times[int(len(times) * 0.99)])
+        after = mount_table()
+
+        if after == before:
+            print(f"  mount table unchanged after {2 * rounds + 1} execs ({len(after)} mounts)")
+        else:
+            print(f"  mount table changed: {len(before)} -> {len(after)} mounts")
+    finally:
+        os.close(devnull)
+        os.close(pidfd)
+        md.stop_container(cid)
+        md.reap_containers()
+
+@main.command()
+@click.option('--rounds', help='Number of containers to start per path', default=50)
+@click.option('--image-name', '-i', help='Image to run', default='ubuntu')
+@click.option('--command', help='Command to run', default='/bin/true')
+def warm(rounds, image_name, command):
+    import contextlib
+    import io
+    import minidocker as md
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    started = []
+
+    def cold():
+        cid, pid, nth, pidfd = md.launch_container([command], image_name, 0, None, None, False,
+                                                   [devnull] * 3)
+        started.append((cid, pid, nth, pidfd))
+
+    def warm_start(sb):
+        md.start_sandbox(sb, [command], 0, None, None, [devnull] * 3)
+        started.append((sb['cid'], sb['pid'], sb['nth'], sb['pidfd']))
+
+    def clean():
+        for cid, pid, nth, pidfd in started:
+            os.close(pidfd)
+            os.waitpid(pid, 0)
+            md.do_clean(cid, pid, nth)
+        started.clear()
+
+    try:
+        print(f"run -i {image_name} {command}, request to exec")
+        with contextlib.redirect_stdout(io.StringIO()):
+            sandboxes = [md.launch_sandbox(image_name) for _ in range(rounds)]
+        for name, fns in (("cold start", [cold] * rounds),
+                          ("warm sandbox", [lambda sb=sb: warm_start(sb) for sb in sandboxes])):
+            times = []
+            for fn in fns:
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    fn()
+                times.append(time.perf_counter() - start)
+            with contextlib.redirect_stdout(io.StringIO()):
+                clean()
+            report_rate(f"  {name}", sum(times) / len(times))
+            times.sort()
+            report(f"  {name} p50", times[len(times) // 2])
+            report(f"  {name} p99", times[int(len(times) * 0.99)])
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            clean()
+        os.close(devnull)
+        md.reap_containers()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,707 @@
+import bz2
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
+import lzma
+import os
+import queue
+import shutil
+import stat
+import tarfile
+import threading
+import time
+import zlib
+from metadata import connect_db, db_transaction
+from snapshot import copy_tree, full_copy_file
+
+# Extracted images live in a content addressable store under the image dir:
+#
+#   <image_dir>/<name>.tar          image tarballs, or .tar.gz/.tar.xz/.tar.bz2
+#   <image_dir>/layers/<digest>/    extracted tree, named by the sha256 of the tar
+#   <image_dir>/layers/<digest>.done  completion marker, holds the digest
+#   <image_dir>/images.db           image name -> layer digests, layer refcounts,
+#                                   sizes and last use
+#
+# An image is a stack of layers, top first like overlay's lowerdir. Images
+# from a tarball have one layer, commit_layer() turns the rw dir of a
+# container into a new layer, whiteouts and all, for an image stacked on top
+# of the one the container runs. Committed images have no tarball to extract
+# their layers from again, so image_gc() never evicts those.
+#
+# A layer is extracted into a temp dir inside layers/, synced, renamed to its
+# digest and then marked done. A tree without a marker is partial and gets
+# rebuilt. Only one process extracts a given image name at a time, the others
+# wait on its lock. Image names with identical tarballs share one tree, and
+# so one page cache.
+#
+# image_gc() evicts the least recently used layers no container runs on
+# once they take more than the budget: the marker is removed and the tree
+# renamed into the trash under the layer's lock, reap_trash() deletes it
+# later without holding anything.
+LAYER_DIR = "layers"
+IMAGES_DB = "images.db"
+LAYER_TMP_PREFIX = ".tmp-"
+LAYER_LOCK_PREFIX = ".lock-"
+LAYER_TRASH_PREFIX = ".trash-"
+LAYER_DONE_SUFFIX = ".done"
+
+# disk space the extracted layers may take before image_gc() evicts some
+IMAGE_CACHE_BUDGET = os.environ.get("MINIDOCKER_IMAGE_BUDGET", "20G")
+# last use is written at most once per interval, so runs rarely write the db
+IMAGE_TOUCH_INTERVAL = 60
+# layers used this recently are never evicted, their container may not be
+# in the metadata yet
+IMAGE_GC_GRACE = 300
+
+# file bodies are written by EXTRACT_WORKERS threads in chunks of at most
+# EXTRACT_CHUNK bytes, with at most EXTRACT_QUEUE chunks read ahead
+EXTRACT_WORKERS = min(16, 2 * (os.cpu_count() or 1))
+EXTRACT_CHUNK = 1 << 20
+EXTRACT_QUEUE = 64
+
+# suffixes tried in order when looking for an image, the codec itself is
+# detected from the magic bytes
+IMAGE_SUFFIXES = ["tar", "tar.gz", "tgz", "tar.xz", "txz", "tar.bz2", "tbz2"]
+CODECS = {
+    'gzip': (b'\x1f\x8b', lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    'xz': (b'\xfd7zXZ\x00', lzma.LZMADecompressor),
+    'bz2': (b'BZh', bz2.BZ2Decompressor),
+}
+
+# compressed images are inflated by a separate thread, DECOMPRESS_CHUNK bytes
+# of input at a time, at most DECOMPRESS_QUEUE chunks ahead of the extractor
+DECOMPRESS_CHUNK = 256 << 10
+DECOMPRESS_QUEUE = 16
+
+_image_dbs = {}
+# user_version of an images db with all the tables and columns below
+IMAGES_DB_VERSION = 1
+
+
+def migrate_images_db(db):
+    # bring the tables up to IMAGES_DB_VERSION, every step can be run twice
+    # source_* tell whether the tarball changed since it was extracted, they
+    # are NULL for committed images. digest is the top layer, layers all of
+    # them joined by ':', top first
+    images_table = """CREATE TABLE IF NOT EXISTS images (
+                          name TEXT PRIMARY KEY,
+                          digest TEXT NOT NULL,
+                          source_size INTEGER,
+                          source_mtime INTEGER,
+                          layers TEXT)"""
+    db.execute(images_table)
+    columns = {c['name']: c for c in db.execute("PRAGMA table_info(images)")}
+    # a db from before multi-layer images, sqlite can't drop NOT NULL in place
+    if columns['source_size']['notnull']:
+        db.execute("ALTER TABLE images RENAME TO images_old")
+        db.execute(images_table)
+        db.execute("INSERT INTO images (name, digest, source_size, source_mtime) "
+                   "SELECT name, digest, source_size, source_mtime FROM images_old")
+        db.execute("DROP TABLE images_old")
+    # refcount is the number of images the layer is part of
+    db.execute("""CREATE TABLE IF NOT EXISTS layers (
+                      digest TEXT PRIMARY KEY,
+                      refcount INTEGER NOT NULL,
+                      size INTEGER,
+                      last_used INTEGER)""")
+    columns = [c['name'] for c in db.execute("PRAGMA table_info(layers)")]
+    for column in ('size', 'last_used'):
+        if column not in columns:
+            db.execute(f"ALTER TABLE layers ADD COLUMN {column} INTEGER")
+    db.execute(f"PRAGMA user_version = {IMAGES_DB_VERSION}")
+
+def open_images_db(image_dir):
+    # one connection per thread, sqlite connections can't be shared
+    db = _image_dbs.get((image_dir, threading.get_ident()))
+    if db is not None:
+        return db
+
+    os.makedirs(image_dir, exist_ok=True)
+    db = connect_db(os.path.join(image_dir, IMAGES_DB))
+    # an up to date db costs a read, only a migration takes the write lock
+    if db.execute("PRAGMA user_version").fetchone()[0] < IMAGES_DB_VERSION:
+        with db_transaction(db):
+            # another process may have migrated it while we waited
+            if db.execute("PRAGMA user_version").fetchone()[0] < IMAGES_DB_VERSION:
+                migrate_images_db(db)
+
+    _image_dbs[(image_dir, threading.get_ident())] = db
+    return db
+
+def layer_path(image_dir, digest):
+    return os.path.join(image_dir, LAYER_DIR, digest)
+
+def image_layers(image):
+    # digests of the layers of an images row, top first
+    return (image['layers'] or image['digest']).split(':')
+
+def parse_size(size):
+    # bytes from e.g. "512M", "20G" or "1048576"
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = str(size).strip().upper().rstrip('B')
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def tree_size(path):
+    # disk usage of path, hardlinked files counted once
+    size = 0
+    inodes = set()
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                if st.st_ino in inodes:
+                    continue
+                inodes.add(st.st_ino)
+            size += st.st_blocks * 512
+    return size
+
+class HashReader:
+    # file wrapper hashing everything read through it
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.hash.update(data)
+        return data
+
+def image_codec(f):
+    # return the codec f is compressed with, None for a plain tar
+    magic = f.peek(8)[:8]
+    for codec, (prefix, _) in CODECS.items():
+        if magic.startswith(prefix):
+            return codec
+    return None
+
+def decompress_chunks(f, codec):
+    new = CODECS[codec][1]
+    d = new()
+    while True:
+        data = f.read(DECOMPRESS_CHUNK)
+        if not data:
+            break
+        while data:
+            out = d.decompress(data)
+            if out:
+                yield out
+            data = b''
+            # concatenated streams, e.g. pigz or pbzip2 output
+            if d.eof:
+                data = d.unused_data
+                if data:
+                    d = new()
+    if not d.eof:
+        raise EOFError(f"truncated {codec} stream")
+
+class PipeReader:
+    # read end of a bounded queue filled with decompressed data by a thread
+    def __init__(self, f, codec):
+        self.queue = queue.Queue(DECOMPRESS_QUEUE)
+        self.chunk = b''
+        self.pos = 0
+        self.done = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.fill, args=(f, codec), daemon=True)
+        self.thread.start()
+
+    def fill(self, f, codec):
+        try:
+            for chunk in decompress_chunks(f, codec):
+                if self.closed:
+                    return
+                self.queue.put(chunk)
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+
+    def read(self, n=-1):
+        parts = []
+        while n != 0:
+            if self.pos == len(self.chunk):
+                if self.done:
+                    break
+                item = self.queue.get()
+                if item is None:
+                    self.done = True
+                    break
+                if isinstance(item, Exception):
+                    self.done = True
+                    raise item
+                self.chunk, self.pos = item, 0
+                continue
+            end = len(self.chunk) if n < 0 else min(len(self.chunk), self.pos + n)
+            parts.append(self.chunk[self.pos:end])
+            if n > 0:
+                n -= end - self.pos
+            self.pos = end
+        return b''.join(parts)
+
+    def close(self):
+        # unblock the thread if the extractor gave up early
+        self.closed = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+@contextlib.contextmanager
+def open_image(image_path):
+    # yield the codec of image_path and a file object reading it as a plain tar
+    with open(image_path, 'rb') as f:
+        codec = image_codec(f)
+        if codec is None:
+            yield codec, f
+            return
+        reader = PipeReader(f, codec)
+        try:
+            yield codec, reader
+        finally:
+            reader.close()
+
+def find_image(image_name, image_dir, image_suffix=None):
+    suffixes = IMAGE_SUFFIXES if image_suffix is None else [image_suffix]
+    for suffix in suffixes:
+        image_path = os.path.join(image_dir, image_name+'.'+suffix)
+        if os.path.exists(image_path):
+            return image_path
+    assert False, f"Cannot find image {image_name} in {image_dir}"
+
+def list_images(image_dir):
+    # names of the images in image_dir
+    names = set()
+    if os.path.isdir(image_dir):
+        for entry in os.listdir(image_dir):
+            for suffix in IMAGE_SUFFIXES:
+                if entry.endswith('.' + suffix):
+                    names.add(entry[:-len(suffix) - 1])
+    return sorted(names)
+
+def nodevs(tarinfo, _):
+    # tarfile can contain device files, we don't want them so filter them out
+    return None if tarinfo.type in (tarfile.CHRTYPE, tarfile.BLKTYPE) else tarinfo
+
+def write_chunk(path, offset, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+    finally:
+        os.close(fd)
+
+def set_attrs(tf, member, path):
+    # same as tarfile, failing to set ownership or times is not fatal
+    try:
+        tf.chown(member, path, False)
+        if not member.issym():
+            tf.chmod(member, path)
+            tf.utime(member, path)
+    except tarfile.ExtractError:
+        pass
+
+def extract_tar(f, dest, workers=EXTRACT_WORKERS):
+    # extract the tar stream f into dest like tarfile.extractall with the nodevs
+    # filter, return the sha256 of the stream
+    #
+    # The archive is read once, in order. Directories, symlinks and fifos are
+    # made right away, file bodies are cut into chunks and written by a pool of
+    # workers. Hardlinks, ownership, modes and mtimes are applied in archive
+    # order once every body is on disk, then directories deepest first.
+    reader = HashReader(f)
+    members = []
+    directories = []
+    made = {os.path.normpath(dest)}
+    extracted = set()
+    # chunks queued but not written yet, by path
+    pending = {}
+    slots = threading.BoundedSemaphore(EXTRACT_QUEUE)
+
+    def settle(key):
+        for job in pending.pop(key, ()):
+            job.result()
+
+    with tarfile.open(fileobj=reader, mode='r|') as tf:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            def submit(key, path, offset, data):
+                slots.acquire()
+                job = pool.submit(write_chunk, path, offset, data)
+                job.add_done_callback(lambda _: slots.release())
+                pending.setdefault(key, []).append(job)
+
+            for member in tf:
+                member = nodevs(member, dest)
+                if member is None:
+                    continue
+                path = os.path.join(dest, member.name).rstrip('/')
+                key = os.path.normpath(path)
+
+                parent = os.path.dirname(key)
+                if parent not in made:
+                    os.makedirs(parent, exist_ok=True)
+                    made.add(parent)
+
+                if member.isdir():
+                    if key not in made:
+                        try:
+                            os.mkdir(path, 0o700)
+                        except FileExistsError:
+                            pass
+                        made.add(key)
+                    directories.append(member)
+                    continue
+
+                # a later member with the same name replaces the earlier one
+                settle(key)
+                if member.issym():
+                    if os.path.lexists(path):
+                        os.unlink(path)
+                    os.symlink(member.linkname, path)
+                elif member.isfifo():
+                    os.mkfifo(path)
+                elif not member.islnk():
+                    if key in extracted:
+                        with open(path, 'wb'):
+                            pass
+                    body = tf.extractfile(member)
+                    offset = 0
+                    while True:
+                        data = body.read(EXTRACT_CHUNK)
+                        if offset and not data:
+                            break
+                        submit(key, path, offset, data)
+                        offset += len(data)
+                        if not data:
+                            break
+                members.append(member)
+                extracted.add(key)
+
+        for jobs in pending.values():
+            for job in jobs:
+                job.result()
+
+        for member in members:
+            path = os.path.join(dest, member.name).rstrip('/')
+            if member.islnk():
+                os.link(os.path.join(dest, member.linkname), path)
+            set_attrs(tf, member, path)
+
+        directories.sort(key=lambda a: a.name, reverse=True)
+        for member in directories:
+            path = os.path.join(dest, member.name)
+            try:
+                tf.chown(member, path, False)
+                tf.utime(member, path)
+                tf.chmod(member, path)
+            except tarfile.ExtractError:
+                pass
+
+    # the digest covers the whole file, trailing zero blocks included
+    while reader.read(1 << 20):
+        pass
+    return reader.hash.hexdigest()
+
+@contextlib.contextmanager
+def layer_lock(image_dir, name, shared=False):
+    # lock on name inside the layer store, dropped when fd is closed.
+    # Runs hold a layer shared until it is mounted, evicting takes it exclusive
+    layers = os.path.join(image_dir, LAYER_DIR)
+    os.makedirs(layers, exist_ok=True)
+    path = os.path.join(layers, LAYER_LOCK_PREFIX + name)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    try:
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"Waiting for another process holding {path}...")
+            fcntl.flock(fd, mode)
+        yield
+    finally:
+        os.close(fd)
+
+def layer_complete(image_dir, digest):
+    try:
+        with open(layer_path(image_dir, digest) + LAYER_DONE_SUFFIX) as f:
+            return f.read().strip() == digest
+    except FileNotFoundError:
+        return False
+
+def mark_complete(image_dir, digest):
+    done = layer_path(image_dir, digest) + LAYER_DONE_SUFFIX
+    with open(done + ".tmp", "w") as f:
+        f.write(digest + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(done + ".tmp", done)
+
+def extract_layer(image_path, image_dir, image_name):
+    # extract image_path into the layer store and return its digest, the
+    # caller holds the lock of image_name
+    tmp = os.path.join(image_dir, LAYER_DIR, LAYER_TMP_PREFIX + image_name)
+    # left over by an extraction that died halfway
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.mkdir(tmp)
+    try:
+        os.chmod(tmp, 0o755)
+        start = time.perf_counter()
+        # the digest is taken on the tar stream, so the same layer compressed
+        # differently is stored once
+        with open_image(image_path) as (codec, f):
+            digest = extract_tar(f, tmp)
+        print(f"Extracted {image_path} ({codec or 'tar'}) in {time.perf_counter() - start:.1f}s")
+        # the tree has to be on disk before it is marked complete, or a crash
+        # could leave a complete looking tree of empty files
+        os.sync()
+
+        publish_layer(image_dir, tmp, digest, tree_size(tmp))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return digest
+
+def publish_layer(image_dir, tmp, digest, size):
+    # move the synced tree tmp into the store as layer digest, tmp is
+    # dropped if the layer is stored already
+    with layer_lock(image_dir, digest):
+        if layer_complete(image_dir, digest):
+            # the same layer is already stored, e.g. under another image name
+            shutil.rmtree(tmp)
+            return
+
+        image_root = layer_path(image_dir, digest)
+        if os.path.lexists(image_root):
+            print(f"Removing partial layer {digest}...")
+            partial = os.path.join(image_dir, LAYER_DIR, LAYER_TMP_PREFIX + digest)
+            shutil.rmtree(partial, ignore_errors=True)
+            os.rename(image_root, partial)
+            shutil.rmtree(partial)
+        os.rename(tmp, image_root)
+        mark_complete(image_dir, digest)
+        with db_transaction(open_images_db(image_dir)) as db:
+            db.execute("INSERT INTO layers (digest, refcount, size) VALUES (?, 0, ?) "
+                       "ON CONFLICT (digest) DO UPDATE SET size = excluded.size",
+                       (digest, size))
+
+def tree_digest(root):
+    # sha256 over the names, metadata, xattrs and contents of everything
+    # below root, in name order
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            rel = os.path.relpath(path, root)
+            h.update(f"{rel}\0{st.st_mode:o}\0{st.st_uid}\0{st.st_gid}\0{st.st_rdev}\0"
+                     f"{st.st_mtime_ns}\0".encode('utf-8', 'surrogateescape'))
+            for attr in sorted(os.listxattr(path, follow_symlinks=False)):
+                h.update(attr.encode() + b"=" + os.getxattr(path, attr, follow_symlinks=False) + b"\0")
+            if stat.S_ISLNK(st.st_mode):
+                h.update(os.readlink(path).encode('utf-8', 'surrogateescape'))
+            elif stat.S_ISREG(st.st_mode):
+                body = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    while chunk := f.read(1 << 20):
+                        body.update(chunk)
+                h.update(body.digest())
+    return h.hexdigest()
+
+def commit_layer(image_dir, tree):
+    # copy tree, the rw dir of a container, into the layer store as a new
+    # layer and return its digest
+    os.makedirs(os.path.join(image_dir, LAYER_DIR), exist_ok=True)
+    tmp = os.path.join(image_dir, LAYER_DIR, f"{LAYER_TMP_PREFIX}commit-{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.mkdir(tmp)
+    try:
+        start = time.perf_counter()
+        # whiteouts are character devices and opaque dirs are marked by an
+        # xattr, copy_tree keeps both
+        copy_tree(tree, tmp, full_copy_file)
+        digest = tree_digest(tmp)
+        os.sync()
+        publish_layer(image_dir, tmp, digest, tree_size(tmp))
+        print(f"Committed {tree} as layer {digest} in {time.perf_counter() - start:.1f}s")
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return digest
+
+def set_image(image_dir, image_name, layers, st=None):
+    # point image_name at layers, top first, st is the stat of its tarball
+    # and None for a committed image
+    with db_transaction(open_images_db(image_dir)) as db:
+        old = db.execute("SELECT digest, layers FROM images WHERE name = ?",
+                         (image_name,)).fetchone()
+        db.execute("INSERT OR REPLACE INTO images (name, digest, source_size, source_mtime, layers) "
+                   "VALUES (?, ?, ?, ?, ?)",
+                   (image_name, layers[0], st and st.st_size, st and st.st_mtime_ns,
+                    ':'.join(layers)))
+        old = set() if old is None else set(image_layers(old))
+        for digest in old - set(layers):
+            db.execute("UPDATE layers SET refcount = refcount - 1 WHERE digest = ?", (digest,))
+        for digest in set(layers) - old:
+            db.execute("INSERT INTO layers (digest, refcount) VALUES (?, 1) "
+                       "ON CONFLICT (digest) DO UPDATE SET refcount = refcount + 1", (digest,))
+
+def stored_image_root(image_dir, image_name, st):
+    # return the layer of image_name if it is complete and the tarball is unchanged
+    image = open_images_db(image_dir).execute(
+        "SELECT digest, source_size, source_mtime FROM images WHERE name = ?",
+        (image_name,)).fetchone()
+    if image is None or (image['source_size'], image['source_mtime']) != \
+            (st.st_size, st.st_mtime_ns):
+        return None
+    if not layer_complete(image_dir, image['digest']):
+        return None
+    return layer_path(image_dir, image['digest'])
+
+def touch_layer(image_dir, digest):
+    now = int(time.time())
+    db = open_images_db(image_dir)
+    layer = db.execute("SELECT last_used FROM layers WHERE digest = ?", (digest,)).fetchone()
+    if layer is not None and (layer['last_used'] or 0) > now - IMAGE_TOUCH_INTERVAL:
+        return
+    with db_transaction(db):
+        db.execute("UPDATE layers SET last_used = ? WHERE digest = ?", (now, digest))
+
+def hold_layer(image_dir, digest, hold):
+    # keep image_gc() off digest for as long as the ExitStack hold is open,
+    # return False if it was evicted before we got the lock
+    lock = contextlib.ExitStack()
+    lock.enter_context(layer_lock(image_dir, digest, shared=True))
+    if not layer_complete(image_dir, digest):
+        lock.close()
+        return False
+    hold.enter_context(lock)
+    return True
+
+def get_image_root(image_name, image_dir, image_suffix=None, hold=None):
+    image_path = find_image(image_name, image_dir, image_suffix)
+    st = os.stat(image_path)
+
+    while True:
+        image_root = stored_image_root(image_dir, image_name, st)
+        if image_root is None:
+            # one process extracts, concurrent runs of the same image wait for it
+            with layer_lock(image_dir, image_name):
+                image_root = stored_image_root(image_dir, image_name, st)
+                if image_root is None:
+                    print(f"Extracting {image_path}...")
+                    digest = extract_layer(image_path, image_dir, image_name)
+                    set_image(image_dir, image_name, [digest], st)
+                    image_root = layer_path(image_dir, digest)
+        # evicted in between, extract it again
+        if hold is None or hold_layer(image_dir, os.path.basename(image_root), hold):
+            break
+
+    touch_layer(image_dir, os.path.basename(image_root))
+    return image_root
+
+def committed_image(image_dir, image_name):
+    # the images row of image_name if it was committed, None otherwise
+    image = open_images_db(image_dir).execute(
+        "SELECT digest, layers, source_size FROM images WHERE name = ?",
+        (image_name,)).fetchone()
+    if image is None or image['source_size'] is not None:
+        return None
+    return image
+
+def get_image_layers(image_name, image_dir, image_suffix=None, hold=None):
+    # return the layer dirs of image_name, top first. With an ExitStack
+    # hold, they can't be evicted until it is closed, e.g. once mounted
+    image = committed_image(image_dir, image_name)
+    if image is None:
+        return [get_image_root(image_name, image_dir, image_suffix, hold)]
+
+    layers = image_layers(image)
+    for digest in layers:
+        # never evicted, so only gone if removed by hand
+        if not (layer_complete(image_dir, digest) if hold is None
+                else hold_layer(image_dir, digest, hold)):
+            raise RuntimeError(f"layer {digest} of {image_name} is missing")
+        touch_layer(image_dir, digest)
+    return [layer_path(image_dir, digest) for digest in layers]
+
+def evict_layer(image_dir, digest, grace=IMAGE_GC_GRACE):
+    # move a layer into the trash and return where it went, None if it
+    # has been used within grace seconds after all
+    trash = os.path.join(image_dir, LAYER_DIR,
+                         f"{LAYER_TRASH_PREFIX}{digest}-{os.getpid()}-{time.monotonic_ns()}")
+    with layer_lock(image_dir, digest):
+        # a run may have picked it up since image_gc() looked, it holds the
+        # lock until it is mounted and has touched it by then
+        layer = open_images_db(image_dir).execute(
+            "SELECT last_used FROM layers WHERE digest = ?", (digest,)).fetchone()
+        if layer is not None and (layer['last_used'] or 0) > time.time() - grace:
+            return None
+        # without its marker the layer is not handed out anymore, a run that
+        # wants it extracts it again
+        try:
+            os.remove(layer_path(image_dir, digest) + LAYER_DONE_SUFFIX)
+        except FileNotFoundError:
+            pass
+        os.rename(layer_path(image_dir, digest), trash)
+        with db_transaction(open_images_db(image_dir)) as db:
+            db.execute("DELETE FROM layers WHERE digest = ? AND refcount = 0", (digest,))
+    return trash
+
+def image_gc(image_dir, budget, in_use, grace=IMAGE_GC_GRACE):
+    # evict the least recently used layers not in in_use until the stored
+    # layers take at most budget bytes, return the evicted digests and the
+    # bytes still in use
+    layers_dir = os.path.join(image_dir, LAYER_DIR)
+    if not os.path.isdir(layers_dir):
+        return [], 0
+
+    db = open_images_db(image_dir)
+    known = {l['digest']: dict(l) for l in db.execute(
+        "SELECT digest, refcount, size, last_used FROM layers")}
+    # committed images could not be rebuilt
+    pinned = set()
+    for image in db.execute("SELECT digest, layers FROM images WHERE source_size IS NULL"):
+        pinned.update(image_layers(image))
+    now = time.time()
+    usage = 0
+    candidates = []
+    for digest in os.listdir(layers_dir):
+        if digest.startswith('.') or digest.endswith(LAYER_DONE_SUFFIX):
+            continue
+        path = layer_path(image_dir, digest)
+        # a tree nobody recorded yet, e.g. one being published right now
+        layer = known.get(digest) or {'digest': digest, 'refcount': 0, 'size': None,
+                                      'last_used': int(os.stat(path).st_ctime)}
+        if layer['size'] is None:
+            layer['size'] = tree_size(path)
+        usage += layer['size']
+        if digest in in_use or digest in pinned or (layer['last_used'] or 0) > now - grace:
+            continue
+        candidates.append(layer)
+
+    # layers no image name points to go first, then the least recently used
+    candidates.sort(key=lambda l: (l['refcount'] > 0, l['last_used'] or 0))
+    evicted = []
+    for layer in candidates:
+        if usage <= budget:
+            break
+        print(f"Evicting layer {layer['digest']} ({layer['size'] >> 20}M)...")
+        if evict_layer(image_dir, layer['digest'], grace) is None:
+            continue
+        usage -= layer['size']
+        evicted.append(layer['digest'])
+    return evicted, usage
+
+def reap_trash(image_dir):
+    layers_dir = os.path.join(image_dir, LAYER_DIR)
+    if not os.path.isdir(layers_dir):
+        return
+    for entry in os.listdir(layers_dir):
+        if entry.startswith(LAYER_TRASH_PREFIX):
+            shutil.rmtree(os.path.join(layers_dir, entry), ignore_errors=True)
@@ -0,0 +1,131 @@
+import contextlib
+import fcntl
+import mmap
+import os
+
+DEFAULT_IPAM_DIR = "."
+
+# The bitmap of a subnet is stored as several levels of 64-bit words.
+# Level 0 has one bit per address, a bit in level k+1 is set when the
+# corresponding word in level k is full, and the top level is one word.
+# Finding a free address walks one word per level, so alloc and release
+# cost the same whether 1 or 60k addresses are in use.
+WORD_BITS = 64
+WORD_BYTES = WORD_BITS // 8
+WORD_FULL = (1 << WORD_BITS) - 1
+
+
+def ipam_path(subnet):
+    return os.path.join(DEFAULT_IPAM_DIR, f"ipam-{subnet.network_address}_{subnet.prefixlen}.bitmap")
+
+def ipam_layout(nbits):
+    # return the byte offset and number of words of each level
+    layout = []
+    offset = 0
+    while True:
+        nwords = (nbits + WORD_BITS - 1) // WORD_BITS
+        layout.append((offset, nwords))
+        offset += nwords * WORD_BYTES
+        if nwords == 1:
+            return layout
+        nbits = nwords
+
+def read_word(mm, offset, i):
+    off = offset + i * WORD_BYTES
+    return int.from_bytes(mm[off:off + WORD_BYTES], 'little')
+
+def write_word(mm, offset, i, word):
+    off = offset + i * WORD_BYTES
+    mm[off:off + WORD_BYTES] = word.to_bytes(WORD_BYTES, 'little')
+
+def first_zero(word):
+    return (~word & (word + 1)).bit_length() - 1
+
+def set_bit(mm, layout, nth):
+    for offset, _ in layout:
+        i, bit = divmod(nth, WORD_BITS)
+        word = read_word(mm, offset, i) | (1 << bit)
+        write_word(mm, offset, i, word)
+        if word != WORD_FULL:
+            return
+        nth = i
+
+def clear_bit(mm, layout, nth):
+    for offset, _ in layout:
+        i, bit = divmod(nth, WORD_BITS)
+        word = read_word(mm, offset, i)
+        write_word(mm, offset, i, word & ~(1 << bit))
+        # upper levels only need updating if this word used to be full
+        if word != WORD_FULL:
+            return
+        nth = i
+
+def init_bitmap(mm, layout, nbits, reserved):
+    # padding bits past the end of every level are marked as used
+    nvalid = nbits
+    for offset, nwords in layout:
+        for i in range(nwords):
+            write_word(mm, offset, i, 0)
+        tail = nvalid % WORD_BITS
+        if tail:
+            write_word(mm, offset, nwords - 1, WORD_FULL & ~((1 << tail) - 1))
+        nvalid = nwords
+    for nth in reserved:
+        set_bit(mm, layout, nth)
+
+@contextlib.contextmanager
+def open_ipam(subnet):
+    nbits = subnet.num_addresses
+    layout = ipam_layout(nbits)
+    top_offset, _ = layout[-1]
+    size = top_offset + WORD_BYTES
+
+    fd = os.open(ipam_path(subnet), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        # the lock is dropped when fd is closed
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        fresh = os.fstat(fd).st_size != size
+        if fresh:
+            os.ftruncate(fd, size)
+        with mmap.mmap(fd, size) as mm:
+            if fresh:
+                # network address, gateway and broadcast address
+                init_bitmap(mm, layout, nbits, (0, 1, nbits - 1))
+            yield mm, layout
+    finally:
+        os.close(fd)
+
+def alloc_bit(mm, layout, subnet):
+    i = 0
+    for offset, _ in reversed(layout):
+        word = read_word(mm, offset, i)
+        if word == WORD_FULL:
+            raise RuntimeError(f"No free address left in {subnet}")
+        i = i * WORD_BITS + first_zero(word)
+    set_bit(mm, layout, i)
+    return i
+
+def ipam_alloc(subnet):
+    # return the offset of a free address inside subnet
+    with open_ipam(subnet) as (mm, layout):
+        return alloc_bit(mm, layout, subnet)
+
+def ipam_alloc_many(subnet, n):
+    # n offsets under one lock, none of them is taken if the subnet runs out
+    with open_ipam(subnet) as (mm, layout):
+        nths = []
+        try:
+            for _ in range(n):
+                nths.append(alloc_bit(mm, layout, subnet))
+        except RuntimeError:
+            for nth in nths:
+                clear_bit(mm, layout, nth)
+            raise
+        return nths
+
+def ipam_release(subnet, nth):
+    with open_ipam(subnet) as (mm, layout):
+        clear_bit(mm, layout, nth)
+
+def ipam_ip(subnet, nth):
+    return subnet.network_address + nth
@@ -1,73 +1,143 @@
-import json
-import os
-import subprocess
+import contextlib
+import sqlite3
 
-DEFAULT_METADATA_FILE = "./metadata.json"
+DEFAULT_METADATA_FILE = "./metadata.db"
 
-def open_md():
-    if not os.path.exists(DEFAULT_METADATA_FILE):
-        open(DEFAULT_METADATA_FILE, "w").write('[]')
+# seconds a writer waits for another process holding the database lock
+METADATA_BUSY_TIMEOUT = 10
 
-    with open(DEFAULT_METADATA_FILE, "r") as json_file:
-        md = json.load(json_file)
+_md = None
+# user_version of a metadata db with all the tables and columns below
+METADATA_DB_VERSION = 2
 
-    return md
+def connect_db(path):
+    # autocommit mode, transactions are opened explicitly with db_transaction()
+    db = sqlite3.connect(path, timeout=METADATA_BUSY_TIMEOUT, isolation_level=None)
+    db.row_factory = sqlite3.Row
 
-def close_md(md):
-    with open(DEFAULT_METADATA_FILE, "w") as json_file:
-        json.dump(md, json_file)
+    # WAL lets readers (ps) run while a run/stop is writing
+    if db.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+        db.execute("PRAGMA journal_mode=WAL")
+    return db
 
-def add_container(cid, pid, nth):
-    md = open_md()
+@contextlib.contextmanager
+def db_transaction(db):
+    # take the write lock up front so concurrent writers queue up
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+def migrate_md(md):
+    # bring the table up to METADATA_DB_VERSION, every step can be run twice.
+    # image is the digest of the image layer the container runs on
+    md.execute("""CREATE TABLE IF NOT EXISTS containers (
+                      cid TEXT PRIMARY KEY,
+                      pid INTEGER NOT NULL,
+                      nth INTEGER NOT NULL,
+                      start_time INTEGER,
+                      image TEXT)""")
+    columns = [c['name'] for c in md.execute("PRAGMA table_info(containers)")]
+    if 'start_time' not in columns:
+        md.execute("ALTER TABLE containers ADD COLUMN start_time INTEGER")
+    if 'image' not in columns:
+        md.execute("ALTER TABLE containers ADD COLUMN image TEXT")
+    md.execute("CREATE INDEX IF NOT EXISTS containers_pid ON containers (pid)")
+    md.execute(f"PRAGMA user_version = {METADATA_DB_VERSION}")
+
+def open_md():
+    global _md
+    if _md is not None:
+        return _md
+
+    md = connect_db(DEFAULT_METADATA_FILE)
+    # an up to date db costs a read, only a migration takes the write lock
+    if md.execute("PRAGMA user_version").fetchone()[0] < METADATA_DB_VERSION:
+        with db_transaction(md):
+            # another process may have migrated it while we waited
+            if md.execute("PRAGMA user_version").fetchone()[0] < METADATA_DB_VERSION:
+                migrate_md(md)
+
+    _md = md
+    return md
 
-    c = {
-        'cid': cid,
-        'pid': pid,
-        'nth': nth,
-    }
+def md_transaction():
+    return db_transaction(open_md())
 
-    md.append(c)
+def add_container(cid, pid, nth, start_time=None, image=None):
+    add_containers([(cid, pid, nth, start_time, image)])
 
-    close_md(md)
+def add_containers(rows):
+    # rows of (cid, pid, nth, start_time, image), all in one transaction
+    with md_transaction() as md:
+        md.executemany("INSERT INTO containers (cid, pid, nth, start_time, image) VALUES (?, ?, ?, ?, ?)",
+                       rows)
 
 def get_container(cid):
     md = open_md()
+    c = md.execute("SELECT cid, pid, nth, start_time, image FROM containers WHERE cid = ?",
+                   (cid,)).fetchone()
+    if c is None:
+        return None
 
-    c = list(filter(lambda x: x['cid'] == cid, md))
+    c = dict(c)
+    c['alive'] = check_pid(c['pid'], c['start_time'])
 
-    close_md(md)
+    return c
 
-    if len(c) == 0:
+def get_container_by_pid(pid):
+    # the container whose init is or was pid. Once pid is reused two rows
+    # may have it, the older one is the container that exited
+    md = open_md()
+    c = md.execute("SELECT cid, pid, nth, start_time, image FROM containers WHERE pid = ? "
+                   "ORDER BY start_time LIMIT 1", (pid,)).fetchone()
+    if c is None:
         return None
 
-    c = c[0]
-    c['alive'] = check_pid(c['pid'])
+    c = dict(c)
+    c['alive'] = check_pid(c['pid'], c['start_time'])
 
     return c
 
-def check_pid(pid):
+def pid_start_time(pid):
+    # return the start time of pid in clock ticks since boot, None if it is gone
     try:
-        output = subprocess.check_output(["ps", str(pid)])
-        return len(output.split(b"\n")) > 1
-    except:
-        return False
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
 
-def list_container():
+    # comm may contain spaces and parens, so fields are counted from the last ')'
+    fields = stat[stat.rindex(b")") + 2:].split()
+    state, start_time = fields[0], fields[19]
+    if state == b"Z":
+        return None
+    return int(start_time)
+
+def check_pid(pid, start_time=None):
+    # a different start time means the pid has been reused by another process
+    t = pid_start_time(pid)
+    return t is not None and (start_time is None or t == start_time)
+
+def all_containers():
     md = open_md()
+    cs = [dict(c) for c in md.execute("SELECT cid, pid, nth, start_time, image FROM containers")]
+    for c in cs:
+        c['alive'] = check_pid(c['pid'], c['start_time'])
+    return cs
 
+def print_containers(cs):
     print("CID\t\t\t\t\tPID\tNth\tStatus")
-    for c in md:
-        cid = c['cid']
-        pid = c['pid']
-        nth = c['nth']
-        status = "Running" if check_pid(pid) else "Killed"
-        print(f"{cid}\t{pid}\t{nth}\t{status}")
+    for c in cs:
+        status = "Running" if c['alive'] else "Killed"
+        print(f"{c['cid']}\t{c['pid']}\t{c['nth']}\t{status}")
 
-    close_md(md)
+def list_container():
+    print_containers(all_containers())
 
 def del_container(cid):
-    md = open_md()
-
-    md[:] = list(filter(lambda x: x['cid'] != cid, md))
-
-    close_md(md)
+    with md_transaction() as md:
+        md.execute("DELETE FROM containers WHERE cid = ?", (cid,))
@@ -6,73 +6,138 @@ import tarfile
 import stat
 import subprocess
 import ipaddress
+import socket
 import signal
+import select
+import selectors
+import fcntl
+import concurrent.futures
+import contextlib
+import threading
 from metadata import *
+from ipam import *
+from rpc import *
+from images import *
+from tarindex import *
+from snapshot import *
 import sys
 import shutil
 import time
+import json
 
 IMAGE_BASE_DIR = os.path.abspath('../images')
 CONTAINER_BASE_DIR = os.path.abspath('../containers')
+# a cleaned up container dir is renamed to CONTAINER_BASE_DIR/.trash-<cid> and
+# deleted by reap_containers(), TEARDOWN_WORKERS trees at a time
+CONTAINER_TRASH_PREFIX = ".trash-"
+TEARDOWN_WORKERS = 2
+# socket of the exec helper, in the container dir
+EXEC_HELPER_SOCKET = "exec.sock"
+# "image=n,..." warm sandboxes minidockerd keeps per image for foreground runs
+WARM_POOL = os.environ.get("MINIDOCKER_WARM_POOL", "")
+# seconds stop waits for a killed container to go away
+STOP_TIMEOUT = 10
+# threads setting up containers at once in run --replicas, and its stages
+REPLICA_PARALLEL = 8
+REPLICA_STAGES = ["image", "ipam", "rootfs", "cgroup", "clone", "metadata", "vnet", "exec"]
 
 VBRIDGE_NAME = "mdbr0"
 VBRIDGE_SUBNET_STR = "172.18.0.0/16"
 VBRIDGE_SUBNET = ipaddress.IPv4Network(VBRIDGE_SUBNET_STR)
 VBRIDGE_SUBNET_BITS = 16
-VBRIDGE_SUBNET_GATEWAY = list(VBRIDGE_SUBNET.hosts())[0]
+VBRIDGE_SUBNET_GATEWAY = ipam_ip(VBRIDGE_SUBNET, 1)
 
 IP_NET_NS_DIR = "/var/run/netns"
+IPV4_FORWARD_FILE = "/proc/sys/net/ipv4/conf/all/forwarding"
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
+# sent by the host once the child's network and cgroup are ready
+START_BYTE = b'\0'
+
+# fingerprint of the host state written after a successful bootstrap
+HOST_STAMP_FILE = "./host.stamp"
 
 CGROUP_BASEDIR = '/sys/fs/cgroup'
 CGROUP_DIR = os.path.join(CGROUP_BASEDIR, 'minidocker')
 
 
-def handle_signal(signum, frame):
-    pass
-
-def get_cidr(ipaddr):
-    return f"{ipaddr}/{VBRIDGE_SUBNET_BITS}"
+def link_exists(name):
+    try:
+        socket.if_nametoindex(name)
+        return True
+    except OSError:
+        return False
+
+def host_fingerprint():
+    # cheap summary of the state set up by host_bootstrap(), None if part of it is missing
+    # iptables rules do not survive a reboot, the boot id covers them
+    if not link_exists(VBRIDGE_NAME):
+        return None
+    try:
+        subtree = open(os.path.join(CGROUP_DIR, 'cgroup.subtree_control')).read().split()
+    except FileNotFoundError:
+        return None
+    if not dev_template_ready():
+        return None
+    boot_id = open(BOOT_ID_FILE).read().strip()
+    forward = open(IPV4_FORWARD_FILE).read().strip()
+    ifindex = socket.if_nametoindex(VBRIDGE_NAME)
+    # a changed allowlist rebuilds the /dev template
+    return f"{boot_id} {ifindex} {forward} {','.join(subtree)} {DEV_ALLOWLIST}"
+
+def read_host_stamp():
+    try:
+        return open(HOST_STAMP_FILE).read()
+    except FileNotFoundError:
+        return None
+
+def host_ready():
+    fingerprint = host_fingerprint()
+    return fingerprint is not None and fingerprint == read_host_stamp()
+
+def host_bootstrap(force=False):
+    lock_fd = os.open(HOST_STAMP_FILE + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        # another process may have finished the bootstrap while we waited
+        if not force and host_ready():
+            return
+
+        print("Bootstrapping host...")
+        # create vbridge
+        if not link_exists(VBRIDGE_NAME):
+            linux.link_add(VBRIDGE_NAME, 'bridge')
+            linux.addr_add(VBRIDGE_NAME, str(VBRIDGE_SUBNET_GATEWAY), VBRIDGE_SUBNET_BITS)
+        linux.link_set_up(VBRIDGE_NAME)
+
+        # add forward rules
+        open(IPV4_FORWARD_FILE, 'w').write('1')
+        output = subprocess.check_output(['iptables', '-t', 'nat', '-L'], text=True)
+        if VBRIDGE_SUBNET_STR not in output:
+            run_cmd(f"iptables -t nat -A POSTROUTING -s {VBRIDGE_SUBNET_STR} ! -o {VBRIDGE_NAME} -j MASQUERADE")
+
+        # create minidocker cpu cgroup
+        os.makedirs(CGROUP_DIR, exist_ok=True)
+        md_cg_subtree = os.path.join(CGROUP_DIR, 'cgroup.subtree_control')
+        open(md_cg_subtree, 'w').write('+cpu +memory')
+
+        build_dev_template()
+
+        tmp = HOST_STAMP_FILE + ".tmp"
+        open(tmp, 'w').write(host_fingerprint())
+        os.replace(tmp, HOST_STAMP_FILE)
+    finally:
+        os.close(lock_fd)
 
 @click.group()
 def main():
-    signal.signal(signal.SIGUSR1, handle_signal)
-    # create vbridge
-    output = subprocess.check_output(['brctl', 'show'], text=True)
-    if VBRIDGE_NAME not in output:
-        run_cmd(f"brctl addbr {VBRIDGE_NAME}")
-        run_cmd(f"ip addr add {get_cidr(VBRIDGE_SUBNET_GATEWAY)} dev {VBRIDGE_NAME}")
-    run_cmd(f"ip link set {VBRIDGE_NAME} up")
-
-    # add forward rules
-    run_cmd("sysctl net.ipv4.conf.all.forwarding=1")
-    output = subprocess.check_output(['iptables', '-t', 'nat', '-L'], text=True)
-    if VBRIDGE_SUBNET_STR not in output:
-        run_cmd(f"iptables -t nat -A POSTROUTING -s {VBRIDGE_SUBNET_STR} ! -o {VBRIDGE_NAME} -j MASQUERADE")
-
-    # create minidocker cpu cgroup
-    os.makedirs(CGROUP_DIR, exist_ok=True)
-    md_cg_subtree = os.path.join(CGROUP_DIR, 'cgroup.subtree_control')
-    open(md_cg_subtree, 'w').write('+cpu +memory')
-
-def get_image_root(image_name, image_dir, image_suffix="tar"):
-    image_root = os.path.join(image_dir, image_name)
-    if os.path.exists(image_root):
-        return image_root
+    if not host_ready():
+        host_bootstrap()
 
-    # extract tarball if image_root does not exist
-    os.makedirs(image_root)
-
-    image_path = os.path.join(image_dir, image_name+'.'+image_suffix)
-    assert os.path.exists(image_path), f"Cannot find image {image_path}"
-
-    with tarfile.open(image_path) as tf:
-        # tarfile can contain device files, we don't want them so filter them out
-        def nodevs(tarinfo, _):
-            return None if tarinfo.type in (tarfile.CHRTYPE, tarfile.BLKTYPE) else tarinfo
-
-        tf.extractall(image_root, filter=nodevs)
-
-    return image_root
+@main.command()
+def init():
+    # redo the host bootstrap, e.g. after the NAT rule has been flushed
+    host_bootstrap(force=True)
 
 def get_container_paths(container_id):
     # return rw, workdir, merged
@@ -84,69 +149,175 @@ def get_container_paths(container_id):
             os.makedirs(each)
     return rw, workdir, rootfs
 
-def create_container_dir(image_name, container_id):
-    image_root = get_image_root(image_name, IMAGE_BASE_DIR)
+def create_container_dir(image_layers, container_id, snapshot=SNAPSHOT_DRIVER):
+    # image_layers are the layer dirs of the image, top first
+    driver = snapshot_driver(snapshot, IMAGE_BASE_DIR, CONTAINER_BASE_DIR)
+    container_dir = os.path.join(CONTAINER_BASE_DIR, container_id)
+    if claim_snapshot(CONTAINER_BASE_DIR, image_layers, driver, container_dir):
+        print("Claimed a pooled root fs")
+        return os.path.join(container_dir, "rootfs")
 
     container_rw, container_workdir, container_rootfs = get_container_paths(container_id)
-
-    linux.mount(
-        'overlay', container_rootfs, 'overlay', linux.MS_NODEV,
-        f"lowerdir={image_root},upperdir={container_rw},workdir={container_workdir}")
+    create_snapshot(driver, image_layers, container_rw, container_workdir, container_rootfs)
 
     return container_rootfs
 
-def makedev(new_root):
-    # Add some basic devices
-    dev_path = os.path.join(new_root, 'dev')
-    devpts_path = os.path.join(dev_path, 'pts')
-    if not os.path.exists(devpts_path):
-        os.makedirs(devpts_path)
-        linux.mount('devpts', devpts_path, 'devpts', 0, '')
+def fill_rootfs_pool(image_name, size, snapshot=SNAPSHOT_DRIVER):
+    # top up the pool of image_name to size ready root fs, return how many were made
+    driver = snapshot_driver(snapshot, IMAGE_BASE_DIR, CONTAINER_BASE_DIR)
+    # the layers can't be evicted until the pool is filled, from then on it counts as in use
+    with contextlib.ExitStack() as hold:
+        image_layers = get_image_layers(image_name, IMAGE_BASE_DIR, hold=hold)
+        current = pool_path(CONTAINER_BASE_DIR, image_layers, driver)
+        # pools of older versions of the image
+        for pool in all_pools(CONTAINER_BASE_DIR):
+            info = pool_info(pool)
+            if pool != current and info is not None and info['image'] == image_name \
+                    and info['driver'] == driver:
+                print(f"Draining outdated pool {pool}...")
+                drain_pool(pool)
+        return fill_pool(CONTAINER_BASE_DIR, image_name, image_layers, driver, size)
+
+# name, major, minor of the character devices created in /dev
+DEV_NODES = [
+    ("null", 1, 3),
+    ("zero", 1, 5),
+    ("full", 1, 7),
+    ("random", 1, 8),
+    ("urandom", 1, 9),
+    ("console", 136, 1),
+    ("tty", 5, 0),
+]
+# entries of /dev besides the nodes above, ptmx points into the container's devpts
+# and shm gets a tmpfs per container
+DEV_EXTRAS = ["ptmx", "shm"]
+# comma separated names out of DEV_NODES and DEV_EXTRAS a container gets in /dev
+DEV_ALLOWLIST = os.environ.get("MINIDOCKER_DEVICES",
+                               ",".join([name for name, _, _ in DEV_NODES] + DEV_EXTRAS))
+# /dev is built once per host in this tmpfs, every container gets it as the
+# lower dir of an overlay on /dev, writable and its own
+DEV_TEMPLATE_DIR = os.path.join(CONTAINER_BASE_DIR, ".dev")
+
+def dev_allowlist():
+    names = [name.strip() for name in DEV_ALLOWLIST.split(',') if name.strip()]
+    known = [name for name, _, _ in DEV_NODES] + DEV_EXTRAS
+    for name in names:
+        if name not in known:
+            raise ValueError(f"unknown device {name}, pick from {','.join(known)}")
+    return names
+
+def dev_template_ready():
+    # pts only exists once the template tmpfs is mounted and filled
+    return os.path.isdir(os.path.join(DEV_TEMPLATE_DIR, 'pts'))
+
+def build_dev_template():
+    # fill a fresh tmpfs at DEV_TEMPLATE_DIR, running containers keep the old one
+    print("Building /dev template...")
+    allowed = dev_allowlist()
+    os.makedirs(DEV_TEMPLATE_DIR, exist_ok=True)
+    if mount_fstype(DEV_TEMPLATE_DIR) == 'tmpfs':
+        linux.umount2(DEV_TEMPLATE_DIR, linux.MNT_DETACH)
+    linux.mount('tmpfs', DEV_TEMPLATE_DIR, 'tmpfs',
+                linux.MS_NOSUID | linux.MS_STRICTATIME, 'mode=755,size=64k')
+
     for i, dev in enumerate(['stdin', 'stdout', 'stderr']):
-        os.symlink('/proc/self/fd/%d' % i, os.path.join(new_root, 'dev', dev))
+        os.symlink('/proc/self/fd/%d' % i, os.path.join(DEV_TEMPLATE_DIR, dev))
+    os.symlink('/proc/self/fd', os.path.join(DEV_TEMPLATE_DIR, 'fd'))
 
     old_umask = os.umask(0)
+    for name, major, minor in DEV_NODES:
+        if name in allowed:
+            os.mknod(os.path.join(DEV_TEMPLATE_DIR, name), 0o666 | stat.S_IFCHR,
+                     os.makedev(major, minor))
+    if 'ptmx' in allowed:
+        os.symlink('pts/ptmx', os.path.join(DEV_TEMPLATE_DIR, 'ptmx'))
+    if 'shm' in allowed:
+        os.mkdir(os.path.join(DEV_TEMPLATE_DIR, 'shm'), 0o1777)
+    # last, dev_template_ready() looks for it
+    os.mkdir(os.path.join(DEV_TEMPLATE_DIR, 'pts'), 0o755)
+    os.umask(old_umask)
 
-    # create /dev/null
-    os.mknod(os.path.join(dev_path, "null"), 0o666 | stat.S_IFCHR, os.makedev(1, 3))
-    # create /dev/zero
-    os.mknod(os.path.join(dev_path, "zero"), 0o666 | stat.S_IFCHR, os.makedev(1, 5))
-    #crete /dev/full
-    os.mknod(os.path.join(dev_path, "full"), 0o666 | stat.S_IFCHR, os.makedev(1, 7))
-    # create /dev/random
-    os.mknod(os.path.join(dev_path, "random"), 0o666 | stat.S_IFCHR, os.makedev(1, 8))
-    # create /dev/urandom
-    os.mknod(os.path.join(dev_path, "urandom"), 0o666 | stat.S_IFCHR, os.makedev(1, 9))
-    #crete /dev/console
-    os.mknod(os.path.join(dev_path, "console"), 0o666 | stat.S_IFCHR, os.makedev(136, 1))
-    #crete /dev/tty
-    os.mknod(os.path.join(dev_path, "tty"), 0o666 | stat.S_IFCHR, os.makedev(5, 0))
+def dev_steps(new_root):
+    # linux.spawn steps giving the container a writable /dev of its own:
+    # a tmpfs holding the upper dir of an overlay with the template below
+    dev_path = os.path.join(new_root, 'dev')
+    upper = os.path.join(dev_path, '.upper')
+    work = os.path.join(dev_path, '.work')
+    steps = [
+        ('mount', 'tmpfs', dev_path, 'tmpfs', linux.MS_NOSUID | linux.MS_STRICTATIME, 'mode=755'),
+        ('mkdir', upper, 0o755),
+        ('mkdir', work, 0o755),
+        # stacked on the tmpfs, which hides .upper and .work
+        ('mount', 'overlay', dev_path, 'overlay', linux.MS_NOSUID,
+         f"lowerdir={DEV_TEMPLATE_DIR},upperdir={upper},workdir={work}"),
+        # a devpts instance of its own, its ptmx backs /dev/ptmx
+        ('mount', 'devpts', os.path.join(dev_path, 'pts'), 'devpts',
+         linux.MS_NOSUID | linux.MS_NOEXEC, 'newinstance,ptmxmode=0666,mode=0620'),
+    ]
+    if 'shm' in dev_allowlist():
+        steps.append(('mount', 'shm', os.path.join(dev_path, 'shm'), 'tmpfs',
+                      linux.MS_NOSUID | linux.MS_NODEV | linux.MS_NOEXEC, 'mode=1777,size=65536k'))
+    return steps
 
-    os.umask(old_umask)
+def makedev(new_root):
+    # Add some basic devices
+    for op, *args in dev_steps(new_root):
+        if op == 'mount':
+            linux.mount(*args)
+        else:
+            os.mkdir(*args)
+
+def pseudofs_mounts(new_root):
+    # source, target, fstype, flags, data of /proc, /sys
+    return [
+        ('proc', os.path.join(new_root, 'proc'), 'proc', 0, ''),
+        ('sysfs', os.path.join(new_root, 'sys'), 'sysfs', 0, ''),
+    ]
 
 def make_pseudofs(new_root):
-    # Create pseudo fs /proc, /sys, /dev
-    linux.mount('proc', os.path.join(new_root, 'proc'), 'proc', 0, '')
-    linux.mount('sysfs', os.path.join(new_root, 'sys'), 'sysfs', 0, '')
-    linux.mount('tmpfs', os.path.join(new_root, 'dev'), 'tmpfs',
-                linux.MS_NOSUID | linux.MS_STRICTATIME, 'mode=755')
+    # Create pseudo fs /proc, /sys
+    for mount_args in pseudofs_mounts(new_root):
+        linux.mount(*mount_args)
+
+def container_init_steps(new_root):
+    # what contain() does between sethostname and pivot_root, as linux.spawn steps
+    steps = [('mount', None, '/', None, linux.MS_PRIVATE | linux.MS_REC, '')]
+    steps += [('mount', *mount_args) for mount_args in pseudofs_mounts(new_root)]
+    steps += dev_steps(new_root)
+    return steps
+
+def container_spec(cmd, container_id, rootfs, ipaddr, gateway, veth, detach, stdio, sync):
+    # linux.spawn() version of contain()
+    start_r, start_w, status_r, status_w = sync
+    spec = {
+        'argv': list(cmd),
+        'root': rootfs,
+        'hostname': container_id,
+        'sync': (start_r, status_w),
+        'close_fds': (start_w, status_r),
+        'stdio': stdio,
+        'net': (veth, str(ipaddr), VBRIDGE_SUBNET_BITS, str(gateway)),
+        'steps': container_init_steps(rootfs),
+    }
+    if detach:
+        spec['stdin_path'] = "./stdin"
+        spec['stdout_path'] = "./stdout"
+    return spec
 
 def container_setup_vnet(ipaddr, gateway, veth):
     # set ip addr
-    run_cmd(f"ip addr add {get_cidr(ipaddr)} dev {veth}")
-    run_cmd(f"ip link set {veth} up")
+    linux.addr_add(veth, str(ipaddr), VBRIDGE_SUBNET_BITS)
+    linux.link_set_up(veth)
     # create routing inside ns
-    run_cmd(f"ip route add default via {gateway} dev {veth}")
+    linux.route_add(None, 0, str(gateway), veth)
 
-def setup_cgroup(container_id, pid, cpu_shares, mlimit, mslimit):
+def setup_cgroup(container_id, cpu_shares, mlimit, mslimit):
+    # the container is cloned straight into the returned cgroup, see open_cgroup()
     print("Setting cgroup...")
     cg_dir = os.path.join(CGROUP_DIR, container_id)
 
-    # Insert the container to new cgroup
     if not os.path.exists(cg_dir):
         os.makedirs(cg_dir)
-    proc_file = os.path.join(cg_dir, 'cgroup.procs')
-    open(proc_file, 'w').write(str(pid))
 
     # cpu cgroup
     if cpu_shares:
@@ -161,13 +332,27 @@ def setup_cgroup(container_id, pid, cpu_shares, mlimit, mslimit):
         msmax_file = os.path.join(cg_dir, 'memory.swap.max')
         open(msmax_file, 'w').write(str(mslimit))
 
+    return cg_dir
+
 def clean_cgroup(container_id):
     print("Host cleaning cgroup...")
     cg_dir = os.path.join(CGROUP_DIR, container_id)
     if os.path.exists(cg_dir):
         os.rmdir(cg_dir)
 
-def contain(cmd, container_id, rootfs, ipaddr, gateway, veth, detach):
+def open_cgroup(cg_dir):
+    # fd for linux.clone3, -1 (the caller's cgroup) if cg_dir does not exist
+    try:
+        return os.open(cg_dir, os.O_RDONLY | os.O_DIRECTORY)
+    except FileNotFoundError:
+        return -1
+
+def contain(cmd, container_id, rootfs, ipaddr, gateway, veth, detach, stdio, sync):
+    start_r, start_w, status_r, status_w = sync
+    os.close(start_w)
+    os.close(status_r)
+
+    redirect_stdio(stdio)
     if detach:
         print("Redirecting stdin, stdout, stderr...")
         fd_in = os.open("./stdin", os.O_RDONLY)
@@ -176,41 +361,127 @@ def contain(cmd, container_id, rootfs, ipaddr, gateway, veth, detach):
         os.dup2(fd_out, sys.stdout.fileno())
         os.dup2(fd_out, sys.stderr.fileno())
 
-    print("Waiting for host signal...")
-    signal.pause()
-    print("Got host signal, continue...")
+    print("Waiting for host...")
+    if os.read(start_r, 1) != START_BYTE:
+        # host closed the pipe without starting us, it failed to set us up
+        os._exit(1)
+    os.close(start_r)
+    print("Host is ready, continue...")
 
-    container_setup_vnet(ipaddr, gateway, veth)
+    setup_container(container_id, rootfs, ipaddr, gateway, veth, status_w)
 
-    linux.sethostname(container_id)
-
-    # make new root private recursively
-    linux.mount(None, "/", None, linux.MS_PRIVATE | linux.MS_REC, '')
-
-    make_pseudofs(rootfs)
-    makedev(rootfs)
-
-    old_root = os.path.join(rootfs, 'old_root')
-    os.makedirs(old_root)
-    linux.pivot_root(rootfs, old_root)
-
-    os.chdir("/")
-
-    linux.umount2('/old_root', linux.MNT_DETACH)
-    os.rmdir('/old_root')
-
-    os.execv(cmd[0], cmd)
+    # status_w is close-on-exec, the host sees EOF once execv succeeds
+    try:
+        os.execv(cmd[0], cmd)
+    except Exception as e:
+        report_child_error(status_w, "exec", e)
 
     # actually we will never reach here!
     os._exit(0)
 
-# maybe called multiple times
+def setup_container(container_id, rootfs, ipaddr, gateway, veth, status_w):
+    # network, hostname and mounts of the container, exits through
+    # report_child_error() if any of them fails
+    stage = "vnet"
+    try:
+        container_setup_vnet(ipaddr, gateway, veth)
+
+        stage = "hostname"
+        linux.sethostname(container_id)
+
+        stage = "mount"
+        # make new root private recursively
+        linux.mount(None, "/", None, linux.MS_PRIVATE | linux.MS_REC, '')
+
+        make_pseudofs(rootfs)
+        makedev(rootfs)
+
+        stage = "pivot_root"
+        # the old root ends up stacked on the new one, nothing is created
+        # in rootfs so it may be read-only
+        os.chdir(rootfs)
+        linux.pivot_root(".", ".")
+        linux.umount2(".", linux.MNT_DETACH)
+
+        os.chdir("/")
+    except Exception as e:
+        report_child_error(status_w, stage, e)
+
+def close_other_fds(*keep):
+    # close every fd above stdio that is not in keep
+    for fd in map(int, os.listdir("/proc/self/fd")):
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def sandbox(container_id, rootfs, ipaddr, gateway, veth, ctl_fd, sync):
+    # clone3 callback of a warm sandbox: set up like contain(), then wait on
+    # ctl_fd for the command and the stdio to exec it with, see start_sandbox()
+    start_r, start_w, status_r, status_w = sync
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for i in range(3):
+        os.dup2(devnull, i)
+    # nothing of the host, the control sockets of the other sandboxes keep
+    # them from seeing the pool go away
+    close_other_fds(start_r, status_w, ctl_fd)
+
+    if os.read(start_r, 1) != START_BYTE:
+        os._exit(1)
+    os.close(start_r)
+
+    setup_container(container_id, rootfs, ipaddr, gateway, veth, status_w)
+    # EOF without an error tells the host we are ready
+    os.close(status_w)
+
+    ctl = socket.socket(fileno=ctl_fd)
+    try:
+        msg, fds = recv_msg(ctl, maxfds=3)
+    except (OSError, ValueError):
+        # the pool is gone
+        os._exit(0)
+    redirect_stdio(fds)
+
+    # ctl is close-on-exec, the host sees EOF once execv succeeds
+    cmd = msg['command']
+    try:
+        os.execv(cmd[0], cmd)
+    except OSError as e:
+        send_msg(ctl, {'error': f"{cmd[0]}: {e}"})
+    os._exit(1)
+
+def report_child_error(status_w, stage, e):
+    print(f"Container setup failed at {stage}: {e}")
+    error = {'stage': stage, 'error': str(e), 'errno': getattr(e, 'errno', None)}
+    try:
+        os.write(status_w, json.dumps(error).encode())
+    except OSError:
+        # nobody is listening, e.g. a detached container
+        pass
+    os._exit(1)
+
+def wait_exec(status_r, clone_time):
+    # block until the child has called execv and return the seconds since clone,
+    # raise if its setup failed
+    data = b''
+    while True:
+        chunk = os.read(status_r, 4096)
+        if not chunk:
+            break
+        data += chunk
+
+    if data:
+        error = json.loads(data)
+        raise RuntimeError(f"Container setup failed at {error['stage']}: {error['error']}")
+    return time.perf_counter() - clone_time
+
 def nth_container():
-    # assuming we launch only one container for now
-    return 1
+    # unique among live containers, also used to name the veth pair
+    return ipam_alloc(VBRIDGE_SUBNET)
 
 def get_next_vnet_ip(nth):
-    return list(VBRIDGE_SUBNET.hosts())[nth]
+    return ipam_ip(VBRIDGE_SUBNET, nth)
 
 def veth_pair_name(nth):
     veth_inside = f"veth{nth}_0"
@@ -229,74 +500,413 @@ def create_vnet(pid, nth):
 
     # link net ns
     os.makedirs(IP_NET_NS_DIR, exist_ok=True)
-    run_cmd(f"ln -sf /proc/{pid}/ns/net {ns_path}")
+    if os.path.lexists(ns_path):
+        os.remove(ns_path)
+    os.symlink(f"/proc/{pid}/ns/net", ns_path)
 
     veth_inside, veth_outside = veth_pair_name(nth)
     # create veth pair
-    run_cmd(f"ip link add {veth_inside} type veth peer name {veth_outside}")
-    run_cmd(f"ip link set {veth_inside} netns {ns}")
+    linux.veth_add(veth_inside, veth_outside)
+    linux.link_set_netns(veth_inside, pid)
 
     # connect to vbridge
-    run_cmd(f"brctl addif {VBRIDGE_NAME} {veth_outside}")
-    run_cmd(f"ip link set {veth_outside} up")
+    linux.link_set_master(veth_outside, VBRIDGE_NAME)
+    linux.link_set_up(veth_outside)
 
 def clean_vnet(pid):
     print("Host cleaning vnet...")
     ns = f"mdns{pid}"
     ns_path = f"/var/run/netns/{ns}"
-    os.remove(ns_path)
+    # not there if create_vnet() failed early
+    if os.path.lexists(ns_path):
+        os.remove(ns_path)
 
 def clean_mount(cid):
     _, _, rootfs = get_container_paths(cid)
     linux.umount(rootfs)
-    shutil.rmtree(os.path.dirname(rootfs))
-
-def do_clean(cid, pid):
+    # deleting a big rw layer takes seconds, reap_containers() does it later
+    os.rename(os.path.dirname(rootfs), os.path.join(CONTAINER_BASE_DIR, CONTAINER_TRASH_PREFIX + cid))
+
+def idle_io():
+    # deleting is never urgent, only use the disk when nobody else does.
+    # I/O priorities are per thread and only honoured by the bfq scheduler
+    linux.ioprio_set(linux.IOPRIO_WHO_PROCESS, 0,
+                     linux.IOPRIO_CLASS_IDLE << linux.IOPRIO_CLASS_SHIFT)
+
+def reap_containers(workers=TEARDOWN_WORKERS):
+    # delete the container dirs in the trash, return how many there were
+    if not os.path.isdir(CONTAINER_BASE_DIR):
+        return 0
+    trash = [os.path.join(CONTAINER_BASE_DIR, entry) for entry in os.listdir(CONTAINER_BASE_DIR)
+             if entry.startswith(CONTAINER_TRASH_PREFIX)]
+    with concurrent.futures.ThreadPoolExecutor(workers, initializer=idle_io) as pool:
+        # another reaper may be deleting the same tree
+        list(pool.map(lambda path: shutil.rmtree(path, ignore_errors=True), trash))
+    return len(trash)
+
+def reap_in_background():
+    # without the daemon a detached child deletes the trash, so the cli returns now
+    if os.fork() == 0:
+        try:
+            os.setsid()
+            # let go of the caller's stdio, e.g. the pipe a $(minidocker stop) reads
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for i in range(3):
+                os.dup2(devnull, i)
+            os.close(devnull)
+            reap_containers()
+        finally:
+            os._exit(0)
+
+def do_clean(cid, pid, nth):
     clean_vnet(pid)
     clean_cgroup(cid)
     clean_mount(cid)
     del_container(cid)
+    ipam_release(VBRIDGE_SUBNET, nth)
+
+def wait_exit(pid, start_time, timeout=None):
+    # pid is not our child, so wait on a pidfd instead of waitpid
+    # return False if it is still there after timeout seconds
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    try:
+        # the pid may have been reused before the pidfd was opened
+        if check_pid(pid, start_time):
+            return bool(select.select([fd], [], [], timeout)[0])
+        return True
+    finally:
+        os.close(fd)
 
 def wait_pid(pid):
     print(f"Waiting for {pid}...")
     _, status = os.waitpid(pid, 0)
     print(f"{pid} has exited with status {status}")
 
-@main.command()
-@click.argument('command', required=True, nargs=-1)
-@click.option('--image-name', '-i', help="Image Name", default='ubuntu')
-@click.option('--cpu-shares', help='CPU Shares (relative weight)', default=0)
-@click.option('--mlimit', help='Memory limit', default=None)
-@click.option('--mslimit', help='Memory(swap) limit', default=None)
-@click.option('--daemon', '-d', help='Run as daemon', is_flag=True)
-def run(command, image_name, cpu_shares, mlimit, mslimit, daemon):
+def launch_container(command, image_name, cpu_shares, mlimit, mslimit, daemon, stdio=None,
+                     native=True, snapshot=SNAPSHOT_DRIVER, ctl_fd=None):
+    # return container id, pid, nth and a pidfd of the started container
+    # native runs the container init in C (linux.spawn) instead of contain()
+    # with ctl_fd it is a warm sandbox waiting there for its command instead
     container_id = str(uuid.uuid4())
 
-    nth = nth_container()
-    ipaddr = get_next_vnet_ip(nth)
-    gateway = VBRIDGE_SUBNET_GATEWAY
-    veth, _ = veth_pair_name(nth)
-
     if not os.path.exists("./stdin"):
         os.mkfifo("./stdin")
     if not os.path.exists("./stdout"):
         os.mkfifo("./stdout")
 
-    rootfs = create_container_dir(image_name, container_id)
+    # the layers can't be evicted until they are mounted, from then on
+    # the container counts as using them
+    with contextlib.ExitStack() as hold:
+        # e.g. an unknown image fails here, before anything is allocated
+        image_layers = get_image_layers(image_name, IMAGE_BASE_DIR, hold=hold)
+
+        nth = nth_container()
+        ipaddr = get_next_vnet_ip(nth)
+        gateway = VBRIDGE_SUBNET_GATEWAY
+        veth, _ = veth_pair_name(nth)
+
+        try:
+            rootfs = create_container_dir(image_layers, container_id, snapshot)
+        except BaseException:
+            ipam_release(VBRIDGE_SUBNET, nth)
+            raise
     print(f"Mount a new root fs for our container: {rootfs}")
 
-    print("Host cloning...")
-    flags = linux.CLONE_NEWPID | linux.CLONE_NEWNS | linux.CLONE_NEWUTS | linux.CLONE_NEWNET
-    cb_args = (command, container_id, rootfs, ipaddr, gateway, veth, daemon)
-    pid = linux.clone(contain, flags, cb_args)
+    try:
+        cg_fd = open_cgroup(setup_cgroup(container_id, cpu_shares, mlimit, mslimit))
+        print("Host cloning...")
+        # start_r/start_w: host -> child start byte, status_r/status_w: child -> host error report
+        start_r, start_w = os.pipe()
+        status_r, status_w = os.pipe()
+        flags = linux.CLONE_NEWPID | linux.CLONE_NEWNS | linux.CLONE_NEWUTS | linux.CLONE_NEWNET
+        sync = (start_r, start_w, status_r, status_w)
+        cb_args = (command, container_id, rootfs, ipaddr, gateway, veth, daemon, stdio, sync)
+        clone_time = time.perf_counter()
+        try:
+            if ctl_fd is not None:
+                pid, pidfd = linux.clone3(sandbox, flags, (container_id, rootfs, ipaddr, gateway, veth,
+                                                           ctl_fd, sync), cg_fd)
+            elif native:
+                pid, pidfd = linux.spawn(container_spec(*cb_args), flags, cg_fd)
+            else:
+                pid, pidfd = linux.clone3(contain, flags, cb_args, cg_fd)
+        except BaseException:
+            os.close(start_w)
+            os.close(status_r)
+            raise
+        finally:
+            if cg_fd != -1:
+                os.close(cg_fd)
+            os.close(start_r)
+            os.close(status_w)
+    except BaseException:
+        # nothing runs in the container yet, give back what was set up for it
+        clean_cgroup(container_id)
+        clean_mount(container_id)
+        ipam_release(VBRIDGE_SUBNET, nth)
+        raise
 
     # here is father process
-    add_container(container_id, pid, nth)
-    create_vnet(pid, nth)
-    setup_cgroup(container_id, pid, cpu_shares, mlimit, mslimit)
+    try:
+        add_container(container_id, pid, nth, pid_start_time(pid),
+                      ':'.join(os.path.basename(layer) for layer in image_layers))
+        create_vnet(pid, nth)
+
+        print("Host resuming child...")
+        os.write(start_w, START_BYTE)
+    except BaseException:
+        # EOF on the start pipe makes the child give up, but it may not
+        # have got to reading it yet
+        os.kill(pid, signal.SIGKILL)
+        os.close(pidfd)
+        os.close(status_r)
+        wait_pid(pid)
+        do_clean(container_id, pid, nth)
+        raise
+    finally:
+        os.close(start_w)
+
+    try:
+        # a detached child blocks on the stdin/stdout fifos, don't wait for it
+        if not daemon:
+            exec_time = wait_exec(status_r, clone_time)
+            if ctl_fd is not None:
+                print(f"Sandbox ready {exec_time * 1000:.1f} ms after clone")
+            else:
+                print(f"Container exec'd {exec_time * 1000:.1f} ms after clone")
+    except RuntimeError:
+        os.close(pidfd)
+        wait_pid(pid)
+        do_clean(container_id, pid, nth)
+        raise
+    finally:
+        os.close(status_r)
+
+    return container_id, pid, nth, pidfd
+
+def launch_sandbox(image_name, snapshot=SNAPSHOT_DRIVER):
+    # a warm sandbox of image_name: cloned, networked and cgrouped, waiting
+    # for start_sandbox(). Return its cid, pid, nth, pidfd, image layers and
+    # the host end of its control socket
+    image_layers = get_image_layers(image_name, IMAGE_BASE_DIR)
+    host_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        cid, pid, nth, pidfd = launch_container(None, image_name, 0, None, None, False,
+                                                snapshot=snapshot, ctl_fd=child_end.fileno())
+    except BaseException:
+        host_end.close()
+        raise
+    finally:
+        child_end.close()
+    return {'cid': cid, 'pid': pid, 'nth': nth, 'pidfd': pidfd, 'image': image_name,
+            'snapshot': snapshot, 'layers': image_layers, 'ctl': host_end}
+
+def start_sandbox(sb, command, cpu_shares, mlimit, mslimit, stdio=None):
+    # exec command in the warm sandbox sb with stdio and these limits, raise
+    # if the exec failed. OSError means sb died while it was waiting
+    setup_cgroup(sb['cid'], cpu_shares, mlimit, mslimit)
+    try:
+        send_msg(sb['ctl'], {'command': list(command)}, stdio or ())
+        try:
+            failed, _ = recv_msg(sb['ctl'])
+        except ConnectionError:
+            return
+    finally:
+        sb['ctl'].close()
+    raise RuntimeError(f"Container setup failed at exec: {failed['error']}")
+
+def launch_replicas(command, image_name, replicas, cpu_shares, mlimit, mslimit,
+                    parallel=REPLICA_PARALLEL, snapshot=SNAPSHOT_DRIVER):
+    # start replicas containers running command, return the started ones as
+    # dicts and the seconds each stage took, per container. The image, the
+    # addresses and the metadata are done once for all of them. rootfs,
+    # cgroup and clone of a container overlap the other ones' on parallel
+    # threads, so do vnet and exec once they are all in the metadata
+    timings = {stage: [] for stage in REPLICA_STAGES}
+
+    def timed(stage, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timings[stage].append(time.perf_counter() - start)
+
+    # the layers can't be evicted until all root fs are mounted
+    hold = contextlib.ExitStack()
+    image_layers = timed("image", get_image_layers, image_name, IMAGE_BASE_DIR, None, hold)
+    try:
+        driver = snapshot_driver(snapshot, IMAGE_BASE_DIR, CONTAINER_BASE_DIR)
+        cs = [{'cid': str(uuid.uuid4()), 'nth': nth}
+              for nth in timed("ipam", ipam_alloc_many, VBRIDGE_SUBNET, replicas)]
+    except BaseException:
+        hold.close()
+        raise
+    flags = linux.CLONE_NEWPID | linux.CLONE_NEWNS | linux.CLONE_NEWUTS | linux.CLONE_NEWNET
+    # a child cloned while another container's pipes are open inherits them,
+    # it must not get a status_w or that container's exec is never seen
+    clone_lock = threading.Lock()
+
+    def prepare(c):
+        cid, nth = c['cid'], c['nth']
+        c['rootfs'] = timed("rootfs", create_container_dir, image_layers, cid, driver)
+        cg_fd = open_cgroup(timed("cgroup", setup_cgroup, cid, cpu_shares, mlimit, mslimit))
+        veth, _ = veth_pair_name(nth)
+        try:
+            with clone_lock:
+                start_r, start_w = os.pipe()
+                status_r, status_w = os.pipe()
+                sync = (start_r, start_w, status_r, status_w)
+                cb_args = (command, cid, c['rootfs'], get_next_vnet_ip(nth), VBRIDGE_SUBNET_GATEWAY,
+                           veth, False, None, sync)
+                try:
+                    c['pid'], c['pidfd'] = timed("clone", linux.spawn, container_spec(*cb_args),
+                                                 flags, cg_fd)
+                except BaseException:
+                    os.close(start_w)
+                    os.close(status_r)
+                    raise
+                finally:
+                    os.close(start_r)
+                    os.close(status_w)
+                c['start_w'], c['status_r'] = start_w, status_r
+        finally:
+            os.close(cg_fd)
+
+    def abort(c):
+        # undo prepare() as far as it went. The other children hold copies
+        # of start_w, closing it would not make this one give up
+        if 'pid' in c:
+            os.kill(c['pid'], signal.SIGKILL)
+            os.close(c['start_w'])
+            os.close(c['status_r'])
+            os.close(c['pidfd'])
+            wait_pid(c['pid'])
+        clean_cgroup(c['cid'])
+        if 'rootfs' in c:
+            clean_mount(c['cid'])
+
+    def start(c):
+        try:
+            timed("vnet", create_vnet, c['pid'], c['nth'])
+            os.write(c['start_w'], START_BYTE)
+            start_time = time.perf_counter()
+        finally:
+            os.close(c['start_w'])
+        try:
+            timings["exec"].append(wait_exec(c['status_r'], start_time))
+        finally:
+            os.close(c['status_r'])
+
+    with concurrent.futures.ThreadPoolExecutor(parallel) as pool:
+        try:
+            futures = [pool.submit(prepare, c) for c in cs]
+            # all of them are done before any gets cleaned up
+            concurrent.futures.wait(futures)
+            hold.close()
+            for future in futures:
+                future.result()
+            image = ':'.join(os.path.basename(layer) for layer in image_layers)
+            timed("metadata", add_containers, [(c['cid'], c['pid'], c['nth'], pid_start_time(c['pid']),
+                                                image) for c in cs])
+        except BaseException:
+            hold.close()
+            print("Setting up the replicas failed, cleaning up...")
+            for c in cs:
+                abort(c)
+                ipam_release(VBRIDGE_SUBNET, c['nth'])
+            raise
+
+        started = []
+        for c, future in [(c, pool.submit(start, c)) for c in cs]:
+            try:
+                future.result()
+                started.append(c)
+            except Exception as e:
+                print(f"{c['cid']} failed to start: {e}")
+                # may still be waiting for its start byte, see abort()
+                os.kill(c['pid'], signal.SIGKILL)
+                os.close(c['pidfd'])
+                wait_pid(c['pid'])
+                do_clean(c['cid'], c['pid'], c['nth'])
+    return started, timings
+
+def print_histogram(name, seconds):
+    # percentiles of seconds and how many fall under each power of two ms
+    if not seconds:
+        return
+    seconds = sorted(seconds)
+    p50 = seconds[len(seconds) // 2] * 1000
+    p99 = seconds[int(len(seconds) * 0.99)] * 1000
+    print(f"{name:<10} n={len(seconds):<6} p50 {p50:.2f} ms  p99 {p99:.2f} ms  max {seconds[-1] * 1000:.2f} ms")
+    buckets = {}
+    for s in seconds:
+        k = 0
+        while 2 ** k < s * 1000:
+            k += 1
+        buckets[k] = buckets.get(k, 0) + 1
+    most = max(buckets.values())
+    for k in range(min(buckets), max(buckets) + 1):
+        n = buckets.get(k, 0)
+        print(f"  <= {2 ** k:>6} ms {n:>6} {'#' * round(40 * n / most)}")
+
+def run_replicas(command, image_name, replicas, cpu_shares, mlimit, mslimit, parallel, snapshot):
+    begin = time.perf_counter()
+    started, timings = launch_replicas(command, image_name, replicas, cpu_shares, mlimit, mslimit,
+                                       parallel, snapshot)
+    elapsed = time.perf_counter() - begin
+    print(f"Started {len(started)}/{replicas} containers in {elapsed:.2f} s, "
+          f"{len(started) / elapsed:.1f} containers/s")
+    for stage in REPLICA_STAGES:
+        print_histogram(stage, timings[stage])
+
+    # clean up each one as soon as it exits
+    by_pid = {c['pid']: c for c in started}
+    for c in started:
+        os.close(c['pidfd'])
+    while by_pid:
+        pid, status = os.waitpid(-1, 0)
+        c = by_pid.pop(pid, None)
+        if c is not None:
+            print(f"{pid} has exited with status {status}")
+            do_clean(c['cid'], pid, c['nth'])
+    reap_in_background()
+
+@main.command()
+@click.argument('command', required=True, nargs=-1)
+@click.option('--image-name', '-i', help="Image Name", default='ubuntu')
+@click.option('--cpu-shares', help='CPU Shares (relative weight)', default=0)
+@click.option('--mlimit', help='Memory limit', default=None)
+@click.option('--mslimit', help='Memory(swap) limit', default=None)
+@click.option('--daemon', '-d', help='Run as daemon', is_flag=True)
+@click.option('--snapshot', help='Snapshot driver of the root fs',
+              type=click.Choice(['auto', *SNAPSHOT_DRIVERS]), default=SNAPSHOT_DRIVER)
+@click.option('--replicas', help='Number of containers to start at once', default=1)
+@click.option('--parallel', help='Containers set up at the same time with --replicas',
+              default=REPLICA_PARALLEL)
+def run(command, image_name, cpu_shares, mlimit, mslimit, daemon, snapshot, replicas, parallel):
+    if replicas > 1:
+        # the cli sets them up and waits for them itself, daemon or not
+        if daemon:
+            raise click.ClickException("--replicas only runs in the foreground")
+        run_replicas(command, image_name, replicas, cpu_shares, mlimit, mslimit, parallel, snapshot)
+        return
 
-    print("Host resuming child...")
-    os.kill(pid, signal.SIGUSR1)
+    reply = daemon_request('run', stdio=not daemon, command=command, image_name=image_name,
+                           cpu_shares=cpu_shares, mlimit=mlimit, mslimit=mslimit, daemon=daemon,
+                           snapshot=snapshot)
+    if reply is not None:
+        if daemon:
+            print(f"Detach {reply['pid']}")
+        else:
+            print(f"{reply['pid']} has exited with status {reply['status']}")
+        return
+
+    container_id, pid, nth, pidfd = launch_container(command, image_name, cpu_shares, mlimit, mslimit,
+                                                     daemon, snapshot=snapshot)
+    os.close(pidfd)
 
     if daemon:
         print(f"Detach {pid}")
@@ -304,92 +914,414 @@ def run(command, image_name, cpu_shares, mlimit, mslimit, daemon):
 
     wait_pid(pid)
 
-    do_clean(container_id, pid)
+    do_clean(container_id, pid, nth)
+    reap_in_background()
+
+def redirect_stdio(stdio):
+    # stdio fds handed over by a minidockerd client
+    if stdio:
+        for i, fd in enumerate(stdio):
+            os.dup2(fd, i)
 
-def container_exec(cmd, cid, pid):
-    # enter namespaces
+def join_container(pid, root_fd):
+    # the container's mounts, /proc, /sys and /dev included, are all there
+    # already, exec only joins them. The pid namespace was joined by the
+    # host before cloning, setns(CLONE_NEWPID) only applies to children.
     print("Entering namespaces...")
-    ns_list = ['net', 'mnt', 'uts', 'pid']
-    ns_flag = [linux.CLONE_NEWNET, linux.CLONE_NEWNS, linux.CLONE_NEWUTS, linux.CLONE_NEWPID]
-    for ns, flag in zip(ns_list, ns_flag):
-        ns_path = f"/proc/{pid}/ns/{ns}"
-        fd = os.open(ns_path, os.O_RDONLY)
-        os.setns(fd, flag)
+    for ns, flag in (('net', linux.CLONE_NEWNET), ('uts', linux.CLONE_NEWUTS),
+                     ('mnt', linux.CLONE_NEWNS)):
+        fd = os.open(f"/proc/{pid}/ns/{ns}", os.O_RDONLY | os.O_CLOEXEC)
+        linux.setns(fd, flag)
         os.close(fd)
 
-    # enter cgroup
-    cg_dir = os.path.join(CGROUP_DIR, cid)
-    if os.path.exists(cg_dir):
-        print("Entering CGroup...")
-        proc_file = os.path.join(cg_dir, 'cgroup.procs')
-        open(proc_file, 'w').write(str(os.getpid()))
-
-    linux.sethostname(cid)
-
-    _, _, rootfs = get_container_paths(cid)
-
-    # make new root private recursively
-    linux.mount(None, "/", None, linux.MS_PRIVATE | linux.MS_REC, '')
-
-    make_pseudofs(rootfs)
-    makedev(rootfs)
-
-    # pivot_root
-    old_root = os.path.join(rootfs, 'old_root')
-    if not os.path.exists(old_root):
-        os.makedirs(old_root)
-    linux.pivot_root(rootfs, old_root)
+    # joining the mount namespace puts us at its root, the container's init
+    # may have moved on to another one
+    os.fchdir(root_fd)
+    os.chroot(".")
     os.chdir("/")
+    os.close(root_fd)
 
-    linux.umount2('/old_root', linux.MNT_DETACH)
-    os.rmdir('/old_root')
+def container_exec(cmd, pid, stdio, root_fd):
+    redirect_stdio(stdio)
+    join_container(pid, root_fd)
 
     os.execv(cmd[0], cmd)
 
     # actually we will never reach here!
     os._exit(0)
 
-@main.command()
-@click.argument('command', required=True, nargs=-1)
-@click.option('--container', '-c', help='Container ID', required=True)
-def exec(command, container):
+def clone_into_container(c, callback, args):
+    # clone3 callback(*args, root_fd) into the pid namespace and cgroup of
+    # container c, return pid and pidfd
+    root_fd = os.open(f"/proc/{c['pid']}/root", os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    pidns_fd = os.open(f"/proc/{c['pid']}/ns/pid", os.O_RDONLY | os.O_CLOEXEC)
+    own_pidns_fd = os.open("/proc/self/ns/pid", os.O_RDONLY | os.O_CLOEXEC)
+    cg_fd = open_cgroup(os.path.join(CGROUP_DIR, c['cid']))
+    try:
+        # children of this thread are born in the container's pid namespace
+        linux.setns(pidns_fd, linux.CLONE_NEWPID)
+        try:
+            return linux.clone3(callback, 0, (*args, root_fd), cg_fd)
+        finally:
+            linux.setns(own_pidns_fd, linux.CLONE_NEWPID)
+    finally:
+        for fd in (root_fd, pidns_fd, own_pidns_fd, cg_fd):
+            if fd != -1:
+                os.close(fd)
+
+def launch_exec(command, container, stdio=None):
+    # return pid and pidfd of the exec process, None if the container does not exist
     c = get_container(container)
     if c is None:
-        print(f"{container} does not exist!")
-        return
-
-    cid = c['cid']
-    pid = c['pid']
+        return None
 
     print("Host exec cloning...")
-    cb_args = (command, cid, pid)
-    pid = linux.clone(container_exec, 0, cb_args)
+    # the exec process starts in the container's cgroup
+    return clone_into_container(c, container_exec, (command, c['pid'], stdio))
+
+def exec_helper_path(cid):
+    return os.path.join(CONTAINER_BASE_DIR, cid, EXEC_HELPER_SOCKET)
+
+def exec_helper(lsock_fd, pid, root_fd):
+    # clone3 callback, lives in the container and spawns the commands sent
+    # over lsock_fd, until the container's init exits and takes it along.
+    # It forks once more to be adopted by that init: an init can't finish
+    # exiting while its pid namespace holds a zombie nobody reaps.
+    if os.fork() != 0:
+        os._exit(0)
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for i in range(3):
+        os.dup2(devnull, i)
+    # nothing of whoever started us, e.g. the pipe a $(minidocker exec) reads
+    close_other_fds(lsock_fd, root_fd)
+    join_container(pid, root_fd)
+
+    lsock = socket.socket(fileno=lsock_fd)
+    sel = selectors.EpollSelector()
+
+    def exited(pidfd, child, conn):
+        sel.unregister(pidfd)
+        os.close(pidfd)
+        _, status = os.waitpid(child, 0)
+        try:
+            send_msg(conn, {'status': os.waitstatus_to_exitcode(status)})
+        except OSError:
+            pass
+        conn.close()
+
+    def request(conn):
+        sel.unregister(conn)
+        try:
+            msg, fds = recv_msg(conn, maxfds=3)
+        except (OSError, ValueError):
+            conn.close()
+            return
+        # posix_spawn is a vfork, far cheaper than forking this interpreter
+        try:
+            child = os.posix_spawn(msg['command'][0], msg['command'], os.environ,
+                                   file_actions=[(os.POSIX_SPAWN_DUP2, fd, i)
+                                                 for i, fd in enumerate(fds)])
+        except OSError as e:
+            send_msg(conn, {'error': f"{msg['command'][0]}: {e}"})
+            conn.close()
+            return
+        finally:
+            for fd in fds:
+                os.close(fd)
+        pidfd = os.pidfd_open(child)
+        sel.register(pidfd, selectors.EVENT_READ, lambda: exited(pidfd, child, conn))
+        try:
+            send_msg(conn, {'pid': child})
+        except OSError:
+            pass
+
+    def accept():
+        conn, _ = lsock.accept()
+        sel.register(conn, selectors.EVENT_READ, lambda: request(conn))
+
+    sel.register(lsock, selectors.EVENT_READ, accept)
+    while True:
+        for key, _ in sel.select():
+            key.data()
+
+def start_exec_helper(c):
+    path = exec_helper_path(c['cid'])
+    print(f"Starting the exec helper of {c['cid']}...")
+    if os.path.exists(path):
+        # left by a helper that died
+        os.remove(path)
+    lsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # bound from here, the helper can't reach the host's fs anymore
+        lsock.bind(path)
+        os.chmod(path, 0o600)
+        lsock.listen(128)
+        child, pidfd = clone_into_container(c, exec_helper, (lsock.fileno(), c['pid']))
+        os.close(pidfd)
+        # gone as soon as the helper is forked
+        os.waitpid(child, 0)
+    finally:
+        lsock.close()
+
+def helper_exec(command, container, stdio=(0, 1, 2)):
+    # run command through the exec helper of container, started if needed,
+    # return its pid in the container and its exit status, None if the
+    # container does not exist
+    c = get_container(container)
+    if c is None:
+        return None
+
+    path = exec_helper_path(c['cid'])
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # only one caller starts it, the others connect once it is up
+            with open(path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    sock.connect(path)
+                except (FileNotFoundError, ConnectionRefusedError):
+                    start_exec_helper(c)
+                    sock.connect(path)
+        send_msg(sock, {'command': list(command)}, stdio)
+        started, _ = recv_msg(sock)
+        if 'error' in started:
+            raise click.ClickException(started['error'])
+        exited, _ = recv_msg(sock)
+    finally:
+        sock.close()
+    return started['pid'], exited['status']
 
-    wait_pid(pid)
+@main.command()
+@click.argument('command', required=True, nargs=-1)
+@click.option('--container', '-c', help='Container ID', required=True)
+@click.option('--helper', help="Fork from the container's exec helper, started on first use",
+              is_flag=True)
+def exec(command, container, helper):
+    if helper:
+        result = helper_exec(command, container)
+        if result is None:
+            print(f"{container} does not exist!")
+        else:
+            print(f"{result[0]} has exited with status {result[1]}")
+        return
+
+    reply = daemon_request('exec', stdio=True, command=command, container=container)
+    if reply is None:
+        child = launch_exec(command, container)
+        if child is None:
+            print(f"{container} does not exist!")
+            return
+        pid, pidfd = child
+        os.close(pidfd)
+        wait_pid(pid)
+    elif reply['pid'] is None:
+        print(f"{container} does not exist!")
+    else:
+        print(f"{reply['pid']} has exited with status {reply['status']}")
 
 @main.command()
 def ps():
-    list_container()
+    reply = daemon_request('ps')
+    if reply is None:
+        list_container()
+    else:
+        print_containers(reply)
+
+@main.group()
+def image():
+    pass
 
-@main.command()
-@click.argument('container_id', required=True, nargs=1)
-def stop(container_id):
+# file type bits of the tar member types, anything else is a regular file
+TAR_FILE_TYPES = {
+    tarfile.DIRTYPE: stat.S_IFDIR,
+    tarfile.SYMTYPE: stat.S_IFLNK,
+    tarfile.FIFOTYPE: stat.S_IFIFO,
+    tarfile.CHRTYPE: stat.S_IFCHR,
+    tarfile.BLKTYPE: stat.S_IFBLK,
+}
+
+@image.command('ls')
+def image_ls():
+    print("NAME\t\tFILES\tSIZE\t\tDIGEST\t\tEXTRACTED")
+    for name in list_images(IMAGE_BASE_DIR):
+        image_path = find_image(name, IMAGE_BASE_DIR)
+        count, total, digest = index_summary(load_index(image_path))
+        extracted = stored_image_root(IMAGE_BASE_DIR, name, os.stat(image_path)) is not None
+        print(f"{name}\t\t{count}\t{total >> 20}M\t\t{digest[:12]}\t{extracted}")
+    # committed images only exist as layers, size is that of the layers on disk
+    db = open_images_db(IMAGE_BASE_DIR)
+    for image in db.execute("SELECT name, digest, layers FROM images WHERE source_size IS NULL "
+                            "ORDER BY name").fetchall():
+        layers = image_layers(image)
+        total = sum(l['size'] or 0 for l in db.execute(
+            f"SELECT size FROM layers WHERE digest IN ({','.join('?' * len(layers))})", layers))
+        print(f"{image['name']}\t\t-\t{total >> 20}M\t\t{image['digest'][:12]}\t{len(layers)} layers")
+
+@image.command('files')
+@click.argument('image_name', required=True)
+@click.argument('path', default='/')
+def image_files(image_name, path):
+    found = False
+    for entry in index_walk(load_index(find_image(image_name, IMAGE_BASE_DIR)), path):
+        found = True
+        mode = stat.filemode(entry['mode'] | TAR_FILE_TYPES.get(entry['type'], stat.S_IFREG))
+        link = f" -> {entry['link']}" if entry['type'] == tarfile.SYMTYPE else ""
+        print(f"{mode}\t{entry['size']}\t/{entry['name']}{link}")
+    if not found:
+        raise click.ClickException(f"{path} is not in {image_name}")
+
+@image.command('du')
+@click.argument('image_name', required=True)
+@click.argument('path', default='/')
+def image_du(image_name, path):
+    mm = load_index(find_image(image_name, IMAGE_BASE_DIR))
+    if path.strip('/') == '':
+        _, total, _ = index_summary(mm)
+    else:
+        total = sum(entry['size'] for entry in index_walk(mm, path))
+    print(f"{total}\t{path}")
+
+@image.command('cp')
+@click.argument('image_name', required=True)
+@click.argument('path', required=True)
+@click.argument('dest', required=True)
+def image_cp(image_name, path, dest):
+    entries = extract_paths(find_image(image_name, IMAGE_BASE_DIR), path, dest)
+    print(f"Extracted {len(entries)} members of {image_name} into {dest}")
+
+def images_in_use():
+    # layers under a container's overlay, exited ones too until they are cleaned up,
+    # and under the pooled root fs
+    in_use = {digest for c in all_containers() if c['image'] for digest in c['image'].split(':')}
+    return in_use | {os.path.basename(layer) for layer in pooled_layers(CONTAINER_BASE_DIR)}
+
+def prune_images(budget):
+    # return the evicted layers and the bytes left, the trees are left for reap_trash()
+    return image_gc(IMAGE_BASE_DIR, parse_size(budget), images_in_use())
+
+@image.command('prune')
+@click.option('--budget', help='Disk space the extracted images may take, e.g. 10G',
+              default=IMAGE_CACHE_BUDGET)
+def image_prune(budget):
+    evicted, usage = prune_images(budget)
+    print(f"Evicted {len(evicted)} layers, {usage >> 20}M of {parse_size(budget) >> 20}M in use")
+    reap_trash(IMAGE_BASE_DIR)
+
+@main.group()
+def pool():
+    pass
+
+@pool.command('fill')
+@click.argument('image_name', required=True)
+@click.option('--size', '-n', help='Number of ready root fs to keep', default=1)
+@click.option('--snapshot', help='Snapshot driver of the root fs',
+              type=click.Choice(["auto"] + list(SNAPSHOT_DRIVERS)), default=SNAPSHOT_DRIVER)
+def pool_fill(image_name, size, snapshot):
+    made = fill_rootfs_pool(image_name, size, snapshot)
+    print(f"Made {made} root fs for {image_name}")
+
+@pool.command('ls')
+def pool_ls():
+    print("IMAGE\t\tDRIVER\t\tREADY\tPOOL")
+    for pool in all_pools(CONTAINER_BASE_DIR):
+        info = pool_info(pool) or {'image': '-', 'driver': '-'}
+        print(f"{info['image']}\t\t{info['driver']}\t\t{len(pool_entries(pool))}\t{os.path.basename(pool)}")
+
+@pool.command('drain')
+@click.argument('image_name', required=False)
+def pool_drain(image_name):
+    for pool in all_pools(CONTAINER_BASE_DIR):
+        info = pool_info(pool)
+        if image_name is None or (info is not None and info['image'] == image_name):
+            print(f"Draining {pool}...")
+            drain_pool(pool)
+
+def freeze_container(container_id, frozen):
+    # stop or resume every process of the container, no-op without cgroup.freeze
+    freeze_file = os.path.join(CGROUP_DIR, container_id, 'cgroup.freeze')
+    if not os.path.exists(freeze_file):
+        return
+    open(freeze_file, 'w').write('1' if frozen else '0')
+    events_file = os.path.join(CGROUP_DIR, container_id, 'cgroup.events')
+    # freezing is asynchronous, wait until the kernel reports it
+    for _ in range(100):
+        if f"frozen {int(frozen)}" in open(events_file).read().splitlines():
+            return
+        time.sleep(0.01)
+    print(f"{container_id} is not {'frozen' if frozen else 'thawed'} yet, going on")
+
+def commit_container(container_id, image_name):
+    # store the rw layer of container_id as the top layer of a new image
+    # image_name, return its layers or None if the container does not exist
     c = get_container(container_id)
     if c is None:
+        return None
+    if not c['image']:
+        raise click.ClickException(f"the image of {container_id} is not recorded")
+    if image_name in list_images(IMAGE_BASE_DIR):
+        raise click.ClickException(f"{image_name} is an image tarball already")
+    container_rw, _, container_rootfs = get_container_paths(c['cid'])
+    # the copy drivers have no rw layer, everything is in rootfs
+    if mount_fstype(container_rootfs) != 'overlay':
+        raise click.ClickException(f"{container_id} does not run on an overlay snapshot")
+
+    print(f"Committing {container_id} as {image_name}...")
+    # keep it from writing while its rw layer is copied
+    freeze_container(c['cid'], True)
+    try:
+        digest = commit_layer(IMAGE_BASE_DIR, container_rw)
+    finally:
+        freeze_container(c['cid'], False)
+
+    layers = [digest] + c['image'].split(':')
+    set_image(IMAGE_BASE_DIR, image_name, layers)
+    return layers
+
+@main.command()
+@click.argument('container_id', required=True)
+@click.option('--image-name', '-t', help='Name of the new image, the container id by default',
+              default=None)
+def commit(container_id, image_name):
+    layers = commit_container(container_id, image_name or container_id)
+    if layers is None:
         print(f"{container_id} does not exist!")
-        return
+    else:
+        print(f"{image_name or container_id}: {len(layers)} layers, top {layers[0][:12]}")
+
+def stop_container(container_id):
+    # return False if the container does not exist, raise if it does not
+    # die, e.g. stuck in D state
+    c = get_container(container_id)
+    if c is None:
+        return False
 
     cid = c['cid']
     pid = c['pid']
+    nth = c['nth']
 
     if c['alive']:
         print(f"Sending SIGKILL to {pid}")
         os.kill(pid, signal.SIGKILL)
+        if not wait_exit(pid, c['start_time'], STOP_TIMEOUT):
+            raise RuntimeError(f"{pid} has not exited {STOP_TIMEOUT} s after SIGKILL")
 
-    while check_pid(pid):
-        time.sleep(0.1)
+    do_clean(cid, pid, nth)
+    return True
 
-    do_clean(cid, pid)
+@main.command()
+@click.argument('container_id', required=True, nargs=1)
+def stop(container_id):
+    reply = daemon_request('stop', container_id=container_id)
+    if reply is None:
+        reply = stop_container(container_id)
+        if reply:
+            reap_in_background()
+    if not reply:
+        print(f"{container_id} does not exist!")
 
 # @main.result_callback()
 # def clean(result, **kwargs):
@@ -0,0 +1,395 @@
+import os
+import click
+import socket
+import selectors
+import queue
+import concurrent.futures
+import resource
+import threading
+import traceback
+from minidocker import *
+
+# the daemon keeps metadata, ipam, the image cache and the host bootstrap
+# warm and serves the minidocker cli over DAEMON_SOCKET. It also watches
+# every container through a pidfd in the same epoll loop and cleans up
+# after detached ones as soon as they exit.
+sel = selectors.EpollSelector()
+
+# seconds between two checks of the extracted images against their budget
+IMAGE_GC_INTERVAL = 60
+
+# set after every run, the pooled root fs are topped up in the background
+pool_refill = threading.Event()
+# set after every cleanup, the trashed container dirs are deleted in the background
+teardown = threading.Event()
+# warm sandboxes per image, see launch_sandbox(). They are started from the
+# loop, one per round while warm_refill is set, as clone3 wants this thread
+warm = {}
+warm_refill = threading.Event()
+
+# threads extracting cold images for runs, their results are handed back
+# to the loop through done and a byte on done_w
+IMAGE_WORKERS = 2
+workers = concurrent.futures.ThreadPoolExecutor(IMAGE_WORKERS)
+done = queue.SimpleQueue()
+done_r, done_w = os.pipe()
+
+
+def reply(conn, result=None, error=None):
+    msg = {'result': result} if error is None else {'error': error}
+    try:
+        send_msg(conn, msg)
+    except OSError:
+        # client went away, e.g. ctrl-c on a foreground run
+        pass
+    conn.close()
+
+def on_exit(pid, callback, start_time=None, pidfd=None):
+    # call callback(exitcode) once pid exits, exitcode is None if pid is not our child
+    fd = pidfd
+    if fd is None:
+        try:
+            fd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            callback(None)
+            return
+    # the pid may have been reused before the pidfd was opened
+    if start_time is not None and not check_pid(pid, start_time):
+        os.close(fd)
+        callback(None)
+        return
+
+    def exited():
+        sel.unregister(fd)
+        os.close(fd)
+        try:
+            _, status = os.waitpid(pid, 0)
+        except ChildProcessError:
+            callback(None)
+            return
+        print(f"{pid} has exited with status {status}")
+        callback(os.waitstatus_to_exitcode(status))
+
+    sel.register(fd, selectors.EVENT_READ, exited)
+
+def off_loop(fn, args, callback):
+    # run fn(*args) on a worker, then callback(result, error) on the loop
+    def work():
+        try:
+            result, error = fn(*args), None
+        except Exception as e:
+            result, error = None, e
+        done.put((callback, result, error))
+        os.write(done_w, b'\0')
+
+    workers.submit(work)
+
+def finish_off_loop():
+    os.read(done_r, 4096)
+    while True:
+        try:
+            callback, result, error = done.get_nowait()
+        except queue.Empty:
+            return
+        callback(result, error)
+
+def when_gone(pid, start_time, callback):
+    # call callback() once pid is gone, without waiting on it: its own
+    # watcher does that
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        callback()
+        return
+    if not check_pid(pid, start_time):
+        os.close(fd)
+        callback()
+        return
+
+    def gone():
+        sel.unregister(fd)
+        os.close(fd)
+        callback()
+
+    sel.register(fd, selectors.EVENT_READ, gone)
+
+def reap(pid):
+    # clean up the container pid was the init of, stop may have done it already
+    c = get_container_by_pid(pid)
+    if c is not None and not c['alive']:
+        print(f"Reaping {c['cid']}...")
+        do_clean(c['cid'], pid, c['nth'])
+        teardown.set()
+
+def adopt_containers():
+    # watch containers started before the daemon, clean up the ones already gone
+    for c in all_containers():
+        on_exit(c['pid'], lambda status, c=c: reap(c['pid']), c['start_time'])
+
+def watch_sandbox(sb):
+    # reaped like any container unless a run claims it and takes over sb['exited']
+    def exited(status):
+        pool = warm.get(sb['image'], [])
+        if sb in pool:
+            pool.remove(sb)
+            sb['ctl'].close()
+            warm_refill.set()
+        sb['exited'](status)
+
+    sb['exited'] = lambda status: reap(sb['pid'])
+    on_exit(sb['pid'], exited, pidfd=sb['pidfd'])
+
+def top_up_warm(sizes):
+    # start one missing warm sandbox, clears warm_refill once every pool is full
+    for image_name, size in sizes.items():
+        pool = warm.setdefault(image_name, [])
+        if len(pool) < size:
+            sb = launch_sandbox(image_name)
+            pool.append(sb)
+            watch_sandbox(sb)
+            print(f"Warm sandbox {sb['cid']} of {image_name} ready ({len(pool)}/{size})")
+            return
+    warm_refill.clear()
+
+def claim_sandbox(command, image_name, cpu_shares, mlimit, mslimit, stdio, snapshot):
+    # exec command in a warm sandbox of image_name, None if there is none
+    pool = warm.get(image_name, [])
+    while pool and snapshot == pool[0]['snapshot']:
+        sb = pool.pop(0)
+        warm_refill.set()
+        if sb['layers'] != get_image_layers(image_name, IMAGE_BASE_DIR):
+            print(f"Stopping outdated sandbox {sb['cid']}...")
+            sb['ctl'].close()
+            stop_container(sb['cid'])
+            teardown.set()
+            continue
+        try:
+            start_sandbox(sb, command, cpu_shares, mlimit, mslimit, stdio)
+        except OSError:
+            # died while waiting, its watcher reaps it
+            continue
+        print(f"Claimed warm sandbox {sb['cid']}")
+        return sb
+    return None
+
+def op_run(conn, stdio, command, image_name, cpu_shares, mlimit, mslimit, daemon,
+           snapshot=SNAPSHOT_DRIVER):
+    # extracting a cold image can take minutes, it is done off the loop.
+    # handle_request() closes stdio when we return, keep copies until then
+    stdio = [os.dup(fd) for fd in stdio]
+
+    def materialized(_, error):
+        try:
+            if error is not None:
+                reply(conn, error=str(error))
+                return
+            start_run(conn, stdio, command, image_name, cpu_shares, mlimit, mslimit, daemon,
+                      snapshot)
+        except Exception as e:
+            traceback.print_exc()
+            reply(conn, error=str(e))
+        finally:
+            for fd in stdio:
+                os.close(fd)
+
+    off_loop(get_image_layers, (image_name, IMAGE_BASE_DIR), materialized)
+
+def start_run(conn, stdio, command, image_name, cpu_shares, mlimit, mslimit, daemon, snapshot):
+    # a detached run reads the stdin/stdout fifos, only foreground ones fit a sandbox
+    sb = None
+    if not daemon:
+        sb = claim_sandbox(command, image_name, cpu_shares, mlimit, mslimit, stdio, snapshot)
+    if sb is not None:
+        def claimed_exited(status):
+            reap(sb['pid'])
+            reply(conn, {'cid': sb['cid'], 'pid': sb['pid'], 'status': status})
+
+        sb['exited'] = claimed_exited
+        return
+
+    cid, pid, nth, pidfd = launch_container(command, image_name, cpu_shares, mlimit, mslimit,
+                                            daemon, stdio or None, snapshot=snapshot)
+    pool_refill.set()
+    if daemon:
+        print(f"Detach {pid}")
+        on_exit(pid, lambda status: reap(pid), pidfd=pidfd)
+        reply(conn, {'cid': cid, 'pid': pid, 'status': None})
+        return
+
+    def exited(status):
+        reap(pid)
+        reply(conn, {'cid': cid, 'pid': pid, 'status': status})
+
+    on_exit(pid, exited, pidfd=pidfd)
+
+def op_exec(conn, stdio, command, container):
+    child = launch_exec(command, container, stdio or None)
+    if child is None:
+        reply(conn, {'pid': None, 'status': None})
+        return
+
+    pid, pidfd = child
+    on_exit(pid, lambda status: reply(conn, {'pid': pid, 'status': status}), pidfd=pidfd)
+
+def op_stop(conn, stdio, container_id):
+    # a killed container may take long to go, e.g. in D state, its exit
+    # is waited for by the loop
+    c = get_container(container_id)
+    if c is None:
+        reply(conn, False)
+        return
+
+    def stopped():
+        try:
+            # its watcher may have cleaned it up already
+            current = get_container(c['cid'])
+            if current is not None and current['pid'] == c['pid']:
+                do_clean(c['cid'], c['pid'], c['nth'])
+        except Exception as e:
+            traceback.print_exc()
+            reply(conn, error=str(e))
+            return
+        reply(conn, True)
+        teardown.set()
+
+    if c['alive']:
+        print(f"Sending SIGKILL to {c['pid']}")
+        os.kill(c['pid'], signal.SIGKILL)
+    when_gone(c['pid'], c['start_time'], stopped)
+
+def op_ps(conn, stdio):
+    reply(conn, all_containers())
+
+def auto_prune():
+    # evicting only renames, the trees are deleted off the loop
+    evicted, _ = prune_images(IMAGE_CACHE_BUDGET)
+    if evicted:
+        threading.Thread(target=reap_trash, args=(IMAGE_BASE_DIR,), daemon=True).start()
+
+def refill_pools(sizes):
+    # keep a pool of sizes[image] mounted root fs per image, off the loop
+    while True:
+        pool_refill.clear()
+        for image_name, size in sizes.items():
+            try:
+                made = fill_rootfs_pool(image_name, size)
+                if made:
+                    print(f"Pooled {made} root fs for {image_name}")
+            except Exception:
+                traceback.print_exc()
+        pool_refill.wait(IMAGE_GC_INTERVAL)
+
+def reap_trash_loop():
+    # starts with whatever a previous daemon left in the trash
+    while True:
+        teardown.clear()
+        try:
+            reap_containers()
+        except Exception:
+            traceback.print_exc()
+        teardown.wait()
+
+OPS = {
+    'run': op_run,
+    'exec': op_exec,
+    'stop': op_stop,
+    'ps': op_ps,
+}
+
+def handle_request(conn):
+    sel.unregister(conn)
+    try:
+        msg, fds = recv_msg(conn, maxfds=3)
+    except (OSError, ValueError):
+        conn.close()
+        return
+
+    try:
+        op = OPS.get(msg.get('op'))
+        if op is None:
+            raise ValueError(f"unknown op {msg.get('op')}")
+        op(conn, fds, **msg['args'])
+    except Exception as e:
+        traceback.print_exc()
+        reply(conn, error=str(e))
+    finally:
+        # the children have their own copies by now
+        for fd in fds:
+            os.close(fd)
+
+def accept(lsock):
+    conn, _ = lsock.accept()
+    sel.register(conn, selectors.EVENT_READ, lambda: handle_request(conn))
+
+def listen_socket():
+    if os.path.exists(DAEMON_SOCKET):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(DAEMON_SOCKET)
+            raise click.ClickException(f"minidockerd is already running on {DAEMON_SOCKET}")
+        except ConnectionRefusedError:
+            # left over from a daemon that died
+            os.remove(DAEMON_SOCKET)
+        finally:
+            probe.close()
+
+    lsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    lsock.bind(DAEMON_SOCKET)
+    os.chmod(DAEMON_SOCKET, 0o600)
+    lsock.listen(128)
+    return lsock
+
+@click.command()
+def main():
+    if not host_ready():
+        host_bootstrap()
+
+    # one pidfd per live container
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    lsock = listen_socket()
+    sel.register(lsock, selectors.EVENT_READ, lambda: accept(lsock))
+    sel.register(done_r, selectors.EVENT_READ, finish_off_loop)
+    print(f"minidockerd listening on {DAEMON_SOCKET}")
+
+    adopt_containers()
+    # left over by a daemon that died while deleting
+    threading.Thread(target=reap_trash, args=(IMAGE_BASE_DIR,), daemon=True).start()
+    threading.Thread(target=reap_trash_loop, daemon=True).start()
+    if parse_pools(ROOTFS_POOL):
+        threading.Thread(target=refill_pools, args=(parse_pools(ROOTFS_POOL),), daemon=True).start()
+    warm_sizes = parse_pools(WARM_POOL)
+    if warm_sizes:
+        warm_refill.set()
+
+    next_prune = time.monotonic()
+    while True:
+        # requests come first, the warm pools are topped up in between
+        timeout = 0 if warm_refill.is_set() else max(0, next_prune - time.monotonic())
+        for key, _ in sel.select(timeout):
+            try:
+                key.data()
+            except Exception:
+                # e.g. a failed cleanup, keep serving the other containers
+                traceback.print_exc()
+
+        if warm_refill.is_set():
+            try:
+                top_up_warm(warm_sizes)
+            except Exception:
+                # e.g. a missing image, retried after the next prune
+                traceback.print_exc()
+                warm_refill.clear()
+
+        if time.monotonic() >= next_prune:
+            next_prune = time.monotonic() + IMAGE_GC_INTERVAL
+            if warm_sizes:
+                warm_refill.set()
+            try:
+                auto_prune()
+            except Exception:
+                traceback.print_exc()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import json
+import os
+import socket
+import struct
+
+DAEMON_SOCKET = os.environ.get("MINIDOCKERD_SOCKET", "./minidockerd.sock")
+
+# every message is a 4-byte length followed by a json body, fds (e.g. the
+# client's stdio) travel as SCM_RIGHTS along with the first bytes
+MSG_HEADER = struct.Struct("!I")
+
+def send_msg(sock, msg, fds=()):
+    body = json.dumps(msg, separators=(',', ':')).encode()
+    data = MSG_HEADER.pack(len(body)) + body
+    if fds:
+        sent = socket.send_fds(sock, [data], list(fds))
+        data = data[sent:]
+    if data:
+        sock.sendall(data)
+
+def recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed in the middle of a message")
+        buf += chunk
+    return bytes(buf)
+
+def recv_msg(sock, maxfds=0):
+    # return the message and the fds passed along with it
+    fds = []
+    if maxfds:
+        header, fds, _, _ = socket.recv_fds(sock, MSG_HEADER.size, maxfds)
+        for fd in fds:
+            os.set_inheritable(fd, False)
+        header += recv_exact(sock, MSG_HEADER.size - len(header))
+    else:
+        header = recv_exact(sock, MSG_HEADER.size)
+
+    size, = MSG_HEADER.unpack(header)
+    return json.loads(recv_exact(sock, size)), fds
+
+def daemon_request(op, stdio=False, **args):
+    # return the result of op in minidockerd, None if the daemon is not running
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(DAEMON_SOCKET)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        send_msg(sock, {'op': op, 'args': args}, (0, 1, 2) if stdio else ())
+        reply, _ = recv_msg(sock)
+    finally:
+        sock.close()
+
+    if 'error' in reply:
+        raise RuntimeError(f"minidockerd: {reply['error']}")
+    return reply['result']
@@ -0,0 +1,332 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+import uuid
+import linux
+
+# A snapshot driver turns image layers into the root fs of a container:
+#
+#   overlay   overlay mount, files are copied up whole on first write
+#   reflink   copy of the tree with FICLONE, blocks are shared until written,
+#             needs a filesystem with reflinks (btrfs, xfs) under both dirs
+#   hardlink  farm of hardlinks to the image files, nothing is ever copied.
+#             The files are the layer store's own, so the farm is mounted
+#             read-only: only for containers that write to tmpfs or volumes,
+#             never picked automatically
+#
+# Images with several layers are stacked by overlay itself, the copy
+# drivers merge them bottom up applying overlay's whiteouts.
+#
+# Every driver leaves a mount on rootfs (the copies are bind mounted onto
+# themselves for pivot_root), so teardown is the same for all of them.
+SNAPSHOT_DRIVER = os.environ.get("MINIDOCKER_SNAPSHOT", "auto")
+# drivers the probe may pick, in order of preference on a tie
+SNAPSHOT_AUTO = ["overlay", "reflink"]
+# the probe result, valid as long as the image and container dirs don't move
+SNAPSHOT_PROBE_FILE = ".snapshot-driver"
+
+# Snapshots can also be made ahead of time into a pool per image and driver,
+# <base_dir>/.pool/<key>/<id>/{rw,workdir,rootfs} with rootfs mounted, and
+# claimed by renaming <id> to the container dir. An entry is made in
+# .tmp-<id> and renamed once mounted, so only complete ones are claimed.
+SNAPSHOT_POOL_DIR = ".pool"
+SNAPSHOT_POOL_INFO = "pool.json"
+SNAPSHOT_POOL_TMP = ".tmp-"
+# number of ready snapshots per image, e.g. "ubuntu=8,alpine=2"
+ROOTFS_POOL = os.environ.get("MINIDOCKER_ROOTFS_POOL", "")
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# how overlay marks a directory that hides everything in the layers below
+OVERLAY_XATTR_PREFIX = "trusted.overlay."
+OVERLAY_OPAQUE_XATTR = OVERLAY_XATTR_PREFIX + "opaque"
+
+
+def overlay_create(lowerdirs, rw, workdir, rootfs):
+    linux.mount('overlay', rootfs, 'overlay', linux.MS_NODEV,
+                f"lowerdir={':'.join(lowerdirs)},upperdir={rw},workdir={workdir}")
+
+def reflink_file(src, dst, st):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    copy_attrs(dst, st, src)
+
+def hardlink_file(src, dst, st):
+    os.link(src, dst)
+
+def full_copy_file(src, dst, st):
+    shutil.copyfile(src, dst, follow_symlinks=False)
+    copy_attrs(dst, st, src)
+
+def copy_attrs(path, st, src=None):
+    os.chown(path, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+    # e.g. security.capability. Of overlay's own ones only opaque is kept, a
+    # committed layer needs it, the others point at inodes of the rw layer
+    if src is not None:
+        for name in os.listxattr(src, follow_symlinks=False):
+            if name == OVERLAY_OPAQUE_XATTR or not name.startswith(OVERLAY_XATTR_PREFIX):
+                os.setxattr(path, name, os.getxattr(src, name, follow_symlinks=False),
+                            follow_symlinks=False)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+def is_whiteout(st):
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+def is_opaque(path):
+    try:
+        return os.getxattr(path, OVERLAY_OPAQUE_XATTR, follow_symlinks=False) == b'y'
+    except OSError:
+        return False
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+def copy_tree(src_root, dst_root, copy_file, merge=False):
+    # recreate src_root in dst_root, regular files go through copy_file
+    # and files hardlinked in the image stay hardlinked. With merge, src_root
+    # is a layer put on top of dst_root the way overlay stacks them:
+    # whiteouts delete, opaque dirs hide what was below them.
+    inodes = {}
+    dirs = [(dst_root, os.lstat(src_root), src_root)]
+    for dirpath, dirnames, filenames in os.walk(src_root):
+        dst_dir = os.path.join(dst_root, os.path.relpath(dirpath, src_root))
+        for name in dirnames + filenames:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(dst_dir, name)
+            st = os.lstat(src)
+            if merge:
+                if is_whiteout(st):
+                    remove_path(dst)
+                    continue
+                if stat.S_ISDIR(st.st_mode) and os.path.isdir(dst) and not os.path.islink(dst):
+                    if is_opaque(src):
+                        shutil.rmtree(dst)
+                        os.mkdir(dst, 0o700)
+                    dirs.append((dst, st, src))
+                    continue
+                remove_path(dst)
+
+            if stat.S_ISDIR(st.st_mode):
+                os.mkdir(dst, 0o700)
+                dirs.append((dst, st, src))
+            elif stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(src), dst)
+                copy_attrs(dst, st, src)
+            elif st.st_nlink > 1 and st.st_ino in inodes:
+                os.link(inodes[st.st_ino], dst)
+            elif stat.S_ISREG(st.st_mode):
+                copy_file(src, dst, st)
+                inodes[st.st_ino] = dst
+            else:
+                os.mknod(dst, st.st_mode, st.st_rdev)
+                copy_attrs(dst, st, src)
+
+    # once nothing is created in them anymore, deepest first
+    for dst, st, src in reversed(dirs):
+        copy_attrs(dst, st, src)
+
+def copy_create(copy_file, readonly=False):
+    def create(lowerdirs, rw, workdir, rootfs):
+        # bottom layer first, every layer above is merged on top
+        for i, lowerdir in enumerate(reversed(lowerdirs)):
+            copy_tree(lowerdir, rootfs, copy_file, merge=i > 0)
+        # pivot_root needs rootfs to be a mount point
+        linux.mount(rootfs, rootfs, None, linux.MS_BIND, '')
+        if readonly:
+            linux.mount(None, rootfs, None, linux.MS_REMOUNT | linux.MS_BIND | linux.MS_RDONLY, '')
+    return create
+
+SNAPSHOT_DRIVERS = {
+    'overlay': overlay_create,
+    'reflink': copy_create(reflink_file),
+    # a write, chmod or chown in place would change the layer under every
+    # other container and its digest
+    'hardlink': copy_create(hardlink_file, readonly=True),
+}
+
+def make_probe_image(path):
+    # a small tree that looks like a bit of /usr
+    for d in range(8):
+        os.makedirs(os.path.join(path, f"d{d}"))
+        for f in range(32):
+            with open(os.path.join(path, f"d{d}", f"f{f}"), 'wb') as fp:
+                fp.write(os.urandom(16 << 10))
+    os.symlink("d0/f0", os.path.join(path, "link"))
+
+def probe_driver(image_dir, base_dir):
+    # return the driver in SNAPSHOT_AUTO that creates a snapshot fastest
+    # between image_dir and base_dir, None if none of them works
+    best, best_time = None, None
+    image = tempfile.mkdtemp(prefix=".probe-", dir=image_dir)
+    try:
+        make_probe_image(image)
+        for driver in SNAPSHOT_AUTO:
+            container = tempfile.mkdtemp(prefix=".probe-", dir=base_dir)
+            rw, workdir, rootfs = (os.path.join(container, d) for d in ("rw", "workdir", "rootfs"))
+            for d in (rw, workdir, rootfs):
+                os.mkdir(d)
+            try:
+                start = time.perf_counter()
+                SNAPSHOT_DRIVERS[driver]([image], rw, workdir, rootfs)
+                seconds = time.perf_counter() - start
+            except (OSError, RuntimeError) as e:
+                print(f"Snapshot driver {driver} does not work here: {e}")
+                continue
+            finally:
+                # a driver may have mounted rootfs before failing
+                remove_snapshot(container)
+            print(f"Snapshot driver {driver}: {seconds * 1000:.2f} ms")
+            if best_time is None or seconds < best_time:
+                best, best_time = driver, seconds
+    finally:
+        shutil.rmtree(image)
+    return best
+
+def snapshot_driver(name, image_dir, base_dir):
+    # resolve "auto" into the probed driver, probing once per pair of devices
+    if name != "auto":
+        if name not in SNAPSHOT_DRIVERS:
+            raise ValueError(f"unknown snapshot driver {name}")
+        return name
+
+    devices = f"{os.stat(image_dir).st_dev}:{os.stat(base_dir).st_dev}"
+    probe_file = os.path.join(base_dir, SNAPSHOT_PROBE_FILE)
+    try:
+        with open(probe_file) as f:
+            probed_devices, driver = f.read().split()
+        if probed_devices == devices:
+            return driver
+    except (FileNotFoundError, ValueError):
+        pass
+
+    driver = probe_driver(image_dir, base_dir)
+    if driver is None:
+        raise RuntimeError("no snapshot driver works here, pick one with --snapshot")
+    with open(probe_file + ".tmp", "w") as f:
+        f.write(f"{devices} {driver}\n")
+    os.rename(probe_file + ".tmp", probe_file)
+    return driver
+
+def create_snapshot(driver, lowerdirs, rw, workdir, rootfs):
+    # lowerdirs are ordered like overlay's lowerdir, the top layer first
+    SNAPSHOT_DRIVERS[driver](lowerdirs, rw, workdir, rootfs)
+
+def parse_pools(pools):
+    # image name -> pool size from e.g. "ubuntu=8,alpine=2"
+    sizes = {}
+    for pool in filter(None, (p.strip() for p in pools.split(','))):
+        image_name, _, size = pool.partition('=')
+        sizes[image_name] = int(size or 1)
+    return sizes
+
+def pool_path(base_dir, lowerdirs, driver):
+    # one pool per driver and stack of layers, a changed image gets a new one
+    key = hashlib.sha256(f"{driver}:{':'.join(lowerdirs)}".encode()).hexdigest()[:16]
+    return os.path.join(base_dir, SNAPSHOT_POOL_DIR, key)
+
+def pool_entries(pool):
+    try:
+        return [e for e in os.listdir(pool) if not e.startswith('.') and e != SNAPSHOT_POOL_INFO]
+    except FileNotFoundError:
+        return []
+
+def pool_info(pool):
+    try:
+        with open(os.path.join(pool, SNAPSHOT_POOL_INFO)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def all_pools(base_dir):
+    root = os.path.join(base_dir, SNAPSHOT_POOL_DIR)
+    if not os.path.isdir(root):
+        return []
+    return [os.path.join(root, key) for key in sorted(os.listdir(root))]
+
+def mount_fstype(path):
+    # fs type of the mount on path, None if nothing is mounted there. A bind
+    # mount of a dir onto itself is invisible to os.path.ismount()
+    fstype = None
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            fields = line.split()
+            # the last mount on path is the visible one
+            if fields[1] == path:
+                fstype = fields[2]
+    return fstype
+
+def remove_snapshot(path):
+    rootfs = os.path.join(path, "rootfs")
+    if mount_fstype(rootfs) is not None:
+        linux.umount(rootfs)
+    shutil.rmtree(path)
+
+def fill_pool(base_dir, image_name, lowerdirs, driver, size):
+    # make snapshots of lowerdirs until the pool has size of them, return
+    # how many were made
+    pool = pool_path(base_dir, lowerdirs, driver)
+    os.makedirs(pool, exist_ok=True)
+    if pool_info(pool) is None:
+        with open(os.path.join(pool, SNAPSHOT_POOL_INFO + ".tmp"), "w") as f:
+            json.dump({'image': image_name, 'driver': driver, 'lowerdirs': lowerdirs}, f)
+        os.rename(os.path.join(pool, SNAPSHOT_POOL_INFO + ".tmp"),
+                  os.path.join(pool, SNAPSHOT_POOL_INFO))
+
+    made = 0
+    while len(pool_entries(pool)) < size:
+        entry_id = str(uuid.uuid4())
+        tmp = os.path.join(pool, SNAPSHOT_POOL_TMP + entry_id)
+        rw, workdir, rootfs = (os.path.join(tmp, d) for d in ("rw", "workdir", "rootfs"))
+        for d in (rw, workdir, rootfs):
+            os.makedirs(d)
+        try:
+            create_snapshot(driver, lowerdirs, rw, workdir, rootfs)
+        except BaseException:
+            remove_snapshot(tmp)
+            raise
+        os.rename(tmp, os.path.join(pool, entry_id))
+        made += 1
+    return made
+
+def claim_snapshot(base_dir, lowerdirs, driver, container_dir):
+    # move a ready snapshot of lowerdirs to container_dir, False if the pool is empty
+    pool = pool_path(base_dir, lowerdirs, driver)
+    for entry in pool_entries(pool):
+        try:
+            # whoever renames it first owns it, the mount on rootfs moves along
+            os.rename(os.path.join(pool, entry), container_dir)
+        except FileNotFoundError:
+            continue
+        if mount_fstype(os.path.join(container_dir, "rootfs")) is not None:
+            return True
+        # made before a reboot, its mount is gone
+        print(f"Dropping stale pooled snapshot {entry}...")
+        remove_snapshot(container_dir)
+    return False
+
+def drain_pool(pool):
+    # unmount and remove every snapshot in pool, half made ones included
+    for entry in os.listdir(pool) if os.path.isdir(pool) else []:
+        if entry != SNAPSHOT_POOL_INFO:
+            remove_snapshot(os.path.join(pool, entry))
+    shutil.rmtree(pool, ignore_errors=True)
+
+def pooled_layers(base_dir):
+    # lowerdirs some pooled snapshot is mounted on
+    layers = set()
+    for pool in all_pools(base_dir):
+        info = pool_info(pool)
+        if info is not None:
+            layers.update(info['lowerdirs'])
+    return layers
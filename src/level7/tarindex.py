@@ -0,0 +1,183 @@
+import hashlib
+import mmap
+import os
+import struct
+import tarfile
+from images import HashReader, nodevs, open_image
+
+# An index of the members of an image tarball is kept next to it in
+# <image>.idx and mmap'd on use, so looking up a path, listing a directory
+# or sizing an image touches only the entries involved:
+#
+#   header | entries sorted by name | names and link targets
+#
+# Offsets are those of the member headers in the tar stream, for a
+# compressed image that is the stream after inflation.
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"MDTI"
+INDEX_VERSION = 1
+# magic, version, number of entries, size and mtime (ns) of the image file,
+# total size of the regular files, sha256 of the tar stream
+INDEX_HEADER = struct.Struct("<4sIIQQQ32s")
+# name offset, name length, link target length, tar type, mode, header
+# offset, size, sha256 of the contents (zeros for anything but files)
+INDEX_ENTRY = struct.Struct("<IHHBxIQQ32s")
+
+
+def member_key(name):
+    # names as stored in the index, "./usr/bin/" and "/usr/bin" are "usr/bin"
+    key = os.path.normpath("/" + name).lstrip("/")
+    return key.encode('utf-8', 'surrogateescape')
+
+def build_index(image_path, index_path, st):
+    entries = {}
+    with open_image(image_path) as (_, f):
+        reader = HashReader(f)
+        with tarfile.open(fileobj=reader, mode='r|') as tf:
+            for member in tf:
+                key = member_key(member.name)
+                link = member.linkname.encode('utf-8', 'surrogateescape')
+                digest = bytes(32)
+                size = 0
+                if member.isreg():
+                    h = hashlib.sha256()
+                    body = tf.extractfile(member)
+                    while chunk := body.read(1 << 20):
+                        h.update(chunk)
+                    digest, size = h.digest(), member.size
+                elif member.islnk():
+                    link = member_key(member.linkname)
+                    target = entries.get(link)
+                    if target is not None:
+                        digest = target[5]
+                # a later member with the same name replaces the earlier one
+                entries[key] = (link, ord(member.type), member.mode, member.offset, size, digest)
+        while reader.read(1 << 20):
+            pass
+
+    names = bytearray()
+    packed = bytearray()
+    for key in sorted(entries):
+        link, type, mode, offset, size, digest = entries[key]
+        packed += INDEX_ENTRY.pack(len(names), len(key), len(link), type, mode, offset, size, digest)
+        names += key + link
+
+    total = sum(e[4] for e in entries.values())
+    header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(entries), st.st_size,
+                               st.st_mtime_ns, total, reader.hash.digest())
+    tmp = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(header + packed + names)
+    os.rename(tmp, index_path)
+
+def map_index(index_path):
+    try:
+        with open(index_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < INDEX_HEADER.size:
+                return None
+            return mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+    except FileNotFoundError:
+        return None
+
+def load_index(image_path):
+    # return the mmap'd index of image_path, built if missing or stale
+    index_path = image_path + INDEX_SUFFIX
+    st = os.stat(image_path)
+    mm = map_index(index_path)
+    if mm is not None:
+        magic, version, _, size, mtime, _, _ = INDEX_HEADER.unpack_from(mm)
+        if (magic, version, size, mtime) == (INDEX_MAGIC, INDEX_VERSION, st.st_size, st.st_mtime_ns):
+            return mm
+        mm.close()
+
+    print(f"Indexing {image_path}...")
+    build_index(image_path, index_path, st)
+    return map_index(index_path)
+
+def index_summary(mm):
+    # number of members, total size of the files and digest of the tar stream
+    _, _, count, _, _, total, digest = INDEX_HEADER.unpack_from(mm)
+    return count, total, digest.hex()
+
+def index_key(mm, i):
+    count = INDEX_HEADER.unpack_from(mm)[2]
+    name_off, name_len = INDEX_ENTRY.unpack_from(mm, INDEX_HEADER.size + i * INDEX_ENTRY.size)[:2]
+    names = INDEX_HEADER.size + count * INDEX_ENTRY.size + name_off
+    return mm[names:names + name_len]
+
+def index_entry(mm, i):
+    count = INDEX_HEADER.unpack_from(mm)[2]
+    name_off, name_len, link_len, type, mode, offset, size, digest = \
+        INDEX_ENTRY.unpack_from(mm, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+    names = INDEX_HEADER.size + count * INDEX_ENTRY.size + name_off
+    return {
+        'name': mm[names:names + name_len].decode('utf-8', 'surrogateescape'),
+        'link': mm[names + name_len:names + name_len + link_len].decode('utf-8', 'surrogateescape'),
+        'type': bytes([type]),
+        'mode': mode,
+        'offset': offset,
+        'size': size,
+        'digest': digest.hex() if any(digest) else None,
+    }
+
+def index_bisect(mm, key):
+    # first entry whose name is not less than key
+    lo, hi = 0, INDEX_HEADER.unpack_from(mm)[2]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if index_key(mm, mid) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def index_find(mm, path):
+    key = member_key(path)
+    i = index_bisect(mm, key)
+    if i < INDEX_HEADER.unpack_from(mm)[2] and index_key(mm, i) == key:
+        return index_entry(mm, i)
+    return None
+
+def index_walk(mm, path):
+    # path and everything below it, in name order
+    key = member_key(path)
+    if key:
+        entry = index_find(mm, path)
+        if entry is not None:
+            yield entry
+        # names below key sort between key + "/" and key + "0"
+        lo, hi = index_bisect(mm, key + b"/"), index_bisect(mm, key + b"0")
+    else:
+        lo, hi = 0, INDEX_HEADER.unpack_from(mm)[2]
+    for i in range(lo, hi):
+        yield index_entry(mm, i)
+
+def extract_paths(image_path, path, dest):
+    # extract path, and everything below it if it is a directory, into dest
+    mm = load_index(image_path)
+    wanted = {}
+    for entry in index_walk(mm, path):
+        # hardlinks need their target on disk first
+        while entry is not None and entry['offset'] not in wanted:
+            wanted[entry['offset']] = entry
+            entry = index_find(mm, entry['link']) if entry['type'] == tarfile.LNKTYPE else None
+    if not wanted:
+        raise FileNotFoundError(f"{path} is not in {image_path}")
+
+    offsets = sorted(wanted)
+    with open_image(image_path) as (codec, f):
+        if codec is None:
+            # plain tar, jump straight to every member
+            with tarfile.open(fileobj=f) as tf:
+                for offset in offsets:
+                    f.seek(offset)
+                    tf.extract(tarfile.TarInfo.fromtarfile(tf), dest, filter=nodevs)
+        else:
+            # a compressed stream can't seek, inflate up to the last member
+            with tarfile.open(fileobj=f, mode='r|') as tf:
+                for member in tf:
+                    if member.offset in wanted:
+                        tf.extract(member, dest, filter=nodevs)
+                    if member.offset >= offsets[-1]:
+                        break
+    return [wanted[offset] for offset in offsets]